@@ -20,6 +20,10 @@
 // use bluetooth serial
 //#define BLE
 
+// report framed binary records instead of csv lines
+// (use protocol binary or auto in pymicroclimate)
+//#define BINARY
+
 
 /* ------------------------------- */
 
@@ -202,6 +206,9 @@ class Record {
     void accumulate(Record other);
     void finalize();
     void report(Stream &io);
+#ifdef BINARY
+    void report_binary(Stream &io);
+#endif
 
     unsigned long time;
     int n;
@@ -324,6 +331,75 @@ void Record::report(Stream &io) {
 };
 
 
+#ifdef BINARY
+// frame: sync (0xAA 0x55), payload length, payload, crc16 of length and
+// payload, all little endian. Payload fields are in csv column order as
+// uint32 (Time, SampleIndex) or float32, missing sensors are NaN
+#define FRAME_SYNC0 0xAA
+#define FRAME_SYNC1 0x55
+#define FRAME_PAYLOAD 40
+
+uint16_t crc16(const uint8_t *data, int n) {
+  // crc-16/ccitt-false
+  uint16_t crc = 0xFFFF;
+  for (int i=0; i<n; i++) {
+    crc ^= ((uint16_t)data[i]) << 8;
+    for (int b=0; b<8; b++) {
+      if (crc & 0x8000) {
+        crc = (crc << 1) ^ 0x1021;
+      } else {
+        crc <<= 1;
+      };
+    };
+  };
+  return crc;
+};
+
+void put_u32(uint8_t *buf, int i, uint32_t v) {
+  for (int b=0; b<4; b++) {
+    buf[i + b] = (v >> (8 * b)) & 0xFF;
+  };
+};
+
+void put_f32(uint8_t *buf, int i, float v) {
+  uint32_t u;
+  memcpy(&u, &v, 4);
+  put_u32(buf, i, u);
+};
+
+void Record::report_binary(Stream &io) {
+  uint8_t frame[FRAME_PAYLOAD + 5];
+  uint8_t *p = frame + 3;
+  frame[0] = FRAME_SYNC0;
+  frame[1] = FRAME_SYNC1;
+  frame[2] = FRAME_PAYLOAD;
+  for (int i=4; i<36; i+=4) put_f32(p, i, NAN);
+  put_u32(p, 0, time);
+#ifdef VEML6030
+  put_f32(p, 4, light);
+#endif
+#ifdef WEATHER
+  put_f32(p, 8, wdir);
+  put_f32(p, 12, wspd);
+  put_f32(p, 16, rain);
+#endif
+#ifdef BME280
+  put_f32(p, 20, wb_temp);
+  put_f32(p, 24, wb_pressure);
+  put_f32(p, 28, wb_humidity);
+#endif
+#ifdef DS18B20
+  put_f32(p, 32, ext_temp);
+#endif
+  put_u32(p, 36, record_count);
+  uint16_t crc = crc16(frame + 2, FRAME_PAYLOAD + 1);
+  frame[FRAME_PAYLOAD + 3] = crc & 0xFF;
+  frame[FRAME_PAYLOAD + 4] = crc >> 8;
+  io.write(frame, FRAME_PAYLOAD + 5);
+};
+#endif
+
+
 void print_header(Stream &io) {
   io.print("#Time,");
 #ifdef VEML6030
@@ -442,7 +518,11 @@ void loop() {
     DBG("finalize")
     avg.finalize();
     DBG("Serial report")
+#ifdef BINARY
+    avg.report_binary(Serial);
+#else
     avg.report(Serial);
+#endif
     DBG("clear")
     avg.clear();
   };
@@ -1,6 +1,13 @@
 import sys
 
+from . import analysis
+from . import archive
+from . import backfill
+from . import bench
+from . import capture
 from . import logger
+from . import rollup
+from . import ui
 
 
 if __name__ == '__main__':
@@ -10,7 +17,19 @@ if __name__ == '__main__':
         cmd = 'log'
     if cmd == 'log':
         logger.run_cmdline()
+    elif cmd == 'replay':
+        capture.run_cmdline()
+    elif cmd == 'bench':
+        bench.run_cmdline()
+    elif cmd == 'backfill':
+        backfill.run_cmdline()
+    elif cmd == 'archive':
+        archive.run_cmdline()
+    elif cmd == 'rollup':
+        rollup.run_cmdline()
+    elif cmd == 'analysis':
+        analysis.run_cmdline()
     elif cmd == 'ui':
-        raise NotImplementedError("No UI yet")
+        ui.run_cmdline()
     else:
         raise ValueError("Unknown command %s" % (cmd, ))
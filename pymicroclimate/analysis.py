@@ -0,0 +1,403 @@
+import argparse
+import datetime
+import io
+import math
+import os
+import sqlite3
+
+import numpy
+
+from . import cache
+from . import config
+from . import logger
+from . import query
+
+
+# summaries are computed per database file, cached in analysis.sqlite
+# and merged to answer queries over any range of files
+columns = [
+    n for n, t in logger.line_tokens
+    if t == float and n not in ('WindDir', )]
+# histogram bin edges per column
+bin_edges = {
+    'Light': numpy.arange(0, 130001, 250.),
+    'WindSpd': numpy.arange(0, 60.01, 0.25),
+    'Rain': numpy.arange(0, 50.01, 0.1),
+    'WBTemp': numpy.arange(-50, 60.01, 0.25),
+    'WBPres': numpy.arange(80000, 110001, 10.),
+    'WBHum': numpy.arange(0, 100.01, 0.5),
+    'ExtTemp': numpy.arange(-50, 60.01, 0.25),
+}
+# wind rose sectors (centered on north) and speed bins
+n_sectors = 16
+speed_edges = numpy.array([0, 0.5, 2, 4, 6, 8, 10, 15, numpy.inf])
+# bump to invalidate cached summaries
+cache_version = 1
+
+
+class Histogram:
+    # counts in fixed bins with counts of values below and above the bins
+    def __init__(self, edges):
+        self.edges = numpy.asarray(edges, dtype='f8')
+        self.counts = numpy.zeros(len(self.edges) + 1, dtype='i8')
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def add(self, values):
+        values = values[numpy.isfinite(values)]
+        i = numpy.searchsorted(self.edges, values, 'right')
+        # values equal to the last edge are in the last bin
+        i[values == self.edges[-1]] -= 1
+        self.counts += numpy.bincount(i, minlength=len(self.counts))
+
+    def merge(self, other):
+        if not numpy.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms have different bins")
+        self.counts += other.counts
+
+    def quantile(self, q):
+        # interpolated within bins, values outside the bins are clipped
+        n = self.n
+        if not n:
+            return math.nan
+        cum = numpy.cumsum(self.counts[1:-1]) + self.counts[0]
+        return float(numpy.interp(
+            q * n, numpy.concatenate([[self.counts[0]], cum]), self.edges))
+
+
+class Sketch:
+    # quantile sketch (a merging t-digest), centroids are small in the
+    # tails so extreme quantiles stay accurate
+    def __init__(self, compression=300):
+        self.compression = compression
+        self.means = numpy.empty(0)
+        self.weights = numpy.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def n(self):
+        return int(self.weights.sum())
+
+    def compress(self, means, weights):
+        if not len(means):
+            return
+        order = numpy.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        # merge neighbouring points into centroids of one unit of the
+        # k1 scale function k(q) = compression / (2 pi) asin(2q - 1)
+        q = (numpy.cumsum(weights) - weights) / total
+        k = self.compression / (2 * math.pi) * numpy.arcsin(2 * q - 1)
+        group = numpy.floor(k - k[0]).astype('i8')
+        w = numpy.bincount(group, weights)
+        keep = w > 0
+        self.means = (numpy.bincount(group, weights * means)[keep] / w[keep])
+        self.weights = w[keep]
+
+    def add(self, values):
+        values = values[numpy.isfinite(values)].astype('f8')
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.compress(
+            numpy.concatenate([self.means, values]),
+            numpy.concatenate([self.weights, numpy.ones(len(values))]))
+
+    def merge(self, other):
+        if not len(other.means):
+            return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress(
+            numpy.concatenate([self.means, other.means]),
+            numpy.concatenate([self.weights, other.weights]))
+
+    def quantile(self, q):
+        if not len(self.means):
+            return math.nan
+        total = self.weights.sum()
+        centers = numpy.cumsum(self.weights) - self.weights / 2.
+        return float(numpy.interp(
+            q * total,
+            numpy.concatenate([[0], centers, [total]]),
+            numpy.concatenate([[self.min], self.means, [self.max]])))
+
+
+class WindRose:
+    # counts of readings by wind direction sector and speed bin
+    def __init__(self):
+        self.counts = numpy.zeros(
+            (n_sectors, len(speed_edges) - 1), dtype='i8')
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def add(self, direction, speed):
+        ok = numpy.isfinite(direction) & numpy.isfinite(speed) & (speed >= 0)
+        width = 360. / n_sectors
+        sector = (
+            ((direction[ok] + width / 2) % 360) // width).astype('i8')
+        sector = numpy.minimum(sector, n_sectors - 1)
+        speed_bin = numpy.searchsorted(speed_edges, speed[ok], 'right') - 1
+        numpy.add.at(self.counts, (sector, speed_bin), 1)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def fractions(self):
+        n = self.n
+        if not n:
+            return self.counts.astype('f8')
+        return self.counts / n
+
+
+class Summary:
+    # histograms and sketches of columns and a wind rose of some rows
+    def __init__(self):
+        self.n = 0
+        # first and last Timestamp
+        self.start = None
+        self.end = None
+        self.histograms = dict([(c, Histogram(bin_edges[c])) for c in columns])
+        self.sketches = dict([(c, Sketch()) for c in columns])
+        self.wind_rose = WindRose()
+
+    def add(self, arr):
+        if not len(arr):
+            return
+        self.n += len(arr)
+        ts = arr['Timestamp']
+        t0, t1 = int(ts.min()), int(ts.max())
+        self.start = t0 if self.start is None else min(self.start, t0)
+        self.end = t1 if self.end is None else max(self.end, t1)
+        for c in columns:
+            self.histograms[c].add(arr[c])
+            self.sketches[c].add(arr[c])
+        self.wind_rose.add(arr['WindDir'], arr['WindSpd'])
+
+    def merge(self, other):
+        if not other.n:
+            return
+        self.n += other.n
+        for a in ('start', 'end'):
+            v = getattr(other, a)
+            mine = getattr(self, a)
+            if mine is None:
+                setattr(self, a, v)
+            else:
+                setattr(self, a, (min if a == 'start' else max)(mine, v))
+        for c in columns:
+            self.histograms[c].merge(other.histograms[c])
+            self.sketches[c].merge(other.sketches[c])
+        self.wind_rose.merge(other.wind_rose)
+
+    def quantiles(self, column, qs):
+        return [self.sketches[column].quantile(q) for q in qs]
+
+    def to_bytes(self):
+        arrs = {
+            'meta': numpy.array([
+                self.n,
+                -1 if self.start is None else self.start,
+                -1 if self.end is None else self.end], dtype='i8'),
+            'wind_rose': self.wind_rose.counts,
+        }
+        for c in columns:
+            s = self.sketches[c]
+            arrs['%s_hist' % c] = self.histograms[c].counts
+            arrs['%s_means' % c] = s.means
+            arrs['%s_weights' % c] = s.weights
+            arrs['%s_range' % c] = numpy.array([s.min, s.max])
+        f = io.BytesIO()
+        numpy.savez(f, **arrs)
+        return f.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        s = cls()
+        with numpy.load(io.BytesIO(data)) as arrs:
+            n, start, end = arrs['meta'].tolist()
+            s.n = n
+            s.start = None if start == -1 and not n else start
+            s.end = None if end == -1 and not n else end
+            s.wind_rose.counts = arrs['wind_rose']
+            for c in columns:
+                s.histograms[c].counts = arrs['%s_hist' % c]
+                sk = s.sketches[c]
+                sk.means = arrs['%s_means' % c]
+                sk.weights = arrs['%s_weights' % c]
+                sk.min, sk.max = arrs['%s_range' % c].tolist()
+        return s
+
+
+def get_path(data_dir):
+    return os.path.join(os.path.expanduser(data_dir), 'analysis.sqlite')
+
+
+def source_version(fn):
+    # changes when a file (or its archive or wal) is written
+    return ','.join([
+        str(v) for v in (cache_version, ) + cache.file_version(fn)])
+
+
+class Cache:
+    # summaries of whole files, recomputed when a file changes
+    def __init__(self, data_dir):
+        self.db = sqlite3.connect(get_path(data_dir))
+        with self.db:
+            self.db.execute(
+                "create table if not exists summaries("
+                "File text primary key, Version text, Data blob)")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fn, chunk_size=100000):
+        key = os.path.basename(fn)
+        version = source_version(fn)
+        r = self.db.execute(
+            "select Version, Data from summaries where File = ?",
+            (key, )).fetchone()
+        if r is not None and r[0] == version:
+            self.hits += 1
+            return Summary.from_bytes(r[1])
+        self.misses += 1
+        s = summarize_file(fn, chunk_size=chunk_size)
+        with self.db:
+            self.db.execute(
+                "insert or replace into summaries values (?, ?, ?)",
+                (key, version, s.to_bytes()))
+        return s
+
+    def close(self):
+        self.db.close()
+
+
+def summarize_file(fn, start=None, end=None, chunk_size=100000):
+    # stream a file in chunks, only rows in [start, end) are included
+    start = query.to_timestamp(start)
+    end = query.to_timestamp(end)
+    s = Summary()
+    for arr in query.iter_chunks(fn, chunk_size):
+        if start is not None:
+            arr = arr[arr['Timestamp'] >= start]
+        if end is not None:
+            arr = arr[arr['Timestamp'] < end]
+        s.add(arr)
+    return s
+
+
+def summarize(data_dir, start=None, end=None, cache=None, chunk_size=100000):
+    # merge cached summaries of files within [start, end), files that
+    # are only partly in the range are summarized without caching
+    t0 = query.to_timestamp(start)
+    t1 = query.to_timestamp(end)
+    close = cache is None
+    if cache is None:
+        cache = Cache(data_dir)
+    s = Summary()
+    try:
+        for fn in query.find_files(data_dir, start, end):
+            fs = cache.get(fn, chunk_size)
+            if not fs.n:
+                continue
+            if (
+                    (t0 is not None and fs.end < t0) or
+                    (t1 is not None and fs.start >= t1)):
+                continue
+            if (
+                    (t0 is None or fs.start >= t0) and
+                    (t1 is None or fs.end < t1)):
+                s.merge(fs)
+            else:
+                s.merge(summarize_file(fn, t0, t1, chunk_size))
+    finally:
+        if close:
+            cache.close()
+    return s
+
+
+def months(start, end):
+    # (month start, next month start) covering [start, end)
+    t = datetime.datetime(start.year, start.month, 1)
+    while t < end:
+        n = datetime.datetime(t.year + t.month // 12, t.month % 12 + 1, 1)
+        yield t, n
+        t = n
+
+
+def summarize_months(data_dir, start, end, chunk_size=100000):
+    cache = Cache(data_dir)
+    try:
+        return [
+            (t0, summarize(data_dir, t0, t1, cache, chunk_size))
+            for (t0, t1) in months(start, end)]
+    finally:
+        cache.close()
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Data directory to analyze")
+    parser.add_argument(
+        '-C', '--column', default='WBTemp', choices=columns,
+        help="Column to summarize")
+    parser.add_argument(
+        '-q', '--quantiles', default='0.05,0.25,0.5,0.75,0.95', type=str,
+        help="Comma separated quantiles")
+    parser.add_argument(
+        '-s', '--start', default=None, type=str,
+        help="Start date (YYYY-MM-DD)")
+    parser.add_argument(
+        '-e', '--end', default=None, type=str,
+        help="End date (YYYY-MM-DD)")
+    parser.add_argument(
+        '-m', '--monthly', action='store_true',
+        help="Summarize each month")
+    parser.add_argument(
+        '-w', '--wind_rose', action='store_true',
+        help="Print wind rose fractions (sector x speed bin)")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    qs = [float(q) for q in args.quantiles.split(',')]
+    start = end = None
+    if args.start is not None:
+        start = datetime.datetime.strptime(args.start, '%Y-%m-%d')
+    if args.end is not None:
+        end = datetime.datetime.strptime(args.end, '%Y-%m-%d')
+    if args.monthly:
+        fns = query.find_files(cfg['data_dir'], start, end)
+        if not len(fns):
+            return
+        stems = [os.path.splitext(os.path.basename(fn))[0] for fn in fns]
+        if start is None:
+            start = query.stem_time(stems[0])
+        if end is None:
+            end = query.period_end(
+                query.stem_time(stems[-1]), cfg['split_by'])
+        summaries = summarize_months(cfg['data_dir'], start, end)
+    else:
+        summaries = [(start, summarize(cfg['data_dir'], start, end))]
+    print("start n %s" % ' '.join(['q%g' % q for q in qs]))
+    for (t, s) in summaries:
+        print("%s %i %s" % (
+            '' if t is None else t.strftime('%Y-%m'), s.n,
+            ' '.join(['%.3f' % v for v in s.quantiles(args.column, qs)])))
+    if args.wind_rose:
+        numpy.set_printoptions(precision=3, suppress=True)
+        s = summaries[0][1]
+        for (t, o) in summaries[1:]:
+            s.merge(o)
+        print(s.wind_rose.fractions())
@@ -0,0 +1,130 @@
+import argparse
+import datetime
+import os
+import shutil
+
+import numpy
+
+from . import binlog
+from . import config
+from . import logger
+from . import query
+
+
+# npz: compressed, cols: directory of uncompressed (memory mappable) .npy
+# bin: memory mappable fixed width binary log
+formats = ('npz', 'cols', 'bin')
+
+
+def get_path(fn, fmt='npz'):
+    if fmt not in formats:
+        raise ValueError("Unknown archive format %s" % fmt)
+    return os.path.splitext(fn)[0] + '.' + fmt
+
+
+def find(fn):
+    # find an archive for a database file
+    for fmt in formats:
+        path = get_path(fn, fmt)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def save(path, arr):
+    # write to a temporary path and rename so partial archives are never read
+    tmp = path + '.tmp'
+    if path.endswith('.bin'):
+        binlog.write(tmp, arr)
+    elif path.endswith('.npz'):
+        with open(tmp, 'wb') as f:
+            numpy.savez_compressed(
+                f, **dict([(n, arr[n]) for n in arr.dtype.names]))
+    else:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for n in arr.dtype.names:
+            numpy.save(os.path.join(tmp, n + '.npy'), arr[n])
+    os.rename(tmp, path)
+
+
+def compact(fn, fmt='npz', remove=False):
+    # convert a closed database file to a columnar archive
+    arr = logger.load_file(fn)
+    arr = arr[numpy.argsort(arr['Timestamp'], kind='stable')]
+    path = get_path(fn, fmt)
+    save(path, arr)
+    if remove:
+        os.remove(fn)
+    return path
+
+
+def load_columns(path, columns=None):
+    # load columns as arrays, memory mapped for cols and bin archives
+    if columns is None:
+        columns = [n for n, _ in logger.row_dtype]
+    if path.endswith('.bin'):
+        return binlog.MappedLog(path).columns(columns=columns)
+    if path.endswith('.npz'):
+        with numpy.load(path) as f:
+            return dict([(n, f[n]) for n in columns])
+    return dict([
+        (n, numpy.load(os.path.join(path, n + '.npy'), mmap_mode='r'))
+        for n in columns])
+
+
+def load(path, start=None, end=None, columns=None):
+    dtype = query.get_dtype(columns)
+    names = [n for n, _ in dtype]
+    cols = load_columns(path, set(names) | set(['Timestamp', ]))
+    # archives are sorted by Timestamp
+    ts = cols['Timestamp']
+    i0 = 0
+    i1 = len(ts)
+    if start is not None:
+        i0 = numpy.searchsorted(ts, query.to_timestamp(start), 'left')
+    if end is not None:
+        i1 = numpy.searchsorted(ts, query.to_timestamp(end), 'left')
+    arr = numpy.empty(max(0, i1 - i0), dtype=dtype)
+    for n in names:
+        arr[n] = cols[n][i0:i1]
+    return arr
+
+
+def compact_dir(data_dir, fmt='npz', remove=False):
+    # archive all but the newest (possibly still open) database file,
+    # files for future periods may have been opened ahead of time
+    fns = [
+        fn for fn in query.find_files(data_dir, end=datetime.datetime.now())
+        if os.path.exists(fn)][:-1]
+    paths = []
+    for fn in fns:
+        if find(fn) is not None:
+            continue
+        paths.append(compact(fn, fmt, remove))
+        print("Archived %s to %s" % (fn, paths[-1]))
+    return paths
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Data directory to archive")
+    parser.add_argument(
+        '-f', '--format', default=None, choices=formats,
+        help="Archive format")
+    parser.add_argument(
+        '-r', '--remove', action='store_true',
+        help="Remove database files after archiving")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    fmt = args.format or cfg['archive'] or 'npz'
+    compact_dir(
+        cfg['data_dir'], fmt, args.remove or cfg['archive_remove'])
@@ -0,0 +1,222 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import numpy
+
+from . import archive
+from . import config
+from . import logger
+from . import query
+from . import rollup
+
+
+tasks = ('index', 'validate', 'rollup', 'archive')
+
+
+def limit_memory(max_memory):
+    # bound the address space of a worker (in MB), linux only
+    if not max_memory:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    n = int(max_memory * 1024 * 1024)
+    resource.setrlimit(resource.RLIMIT_AS, (n, n))
+
+
+def index_file(fn, chunk_size):
+    if not os.path.exists(fn):
+        # archived and removed
+        return {'rows': 0}
+    db = sqlite3.connect(fn)
+    logger.create_table(db)
+    n = db.execute('select count(*) from weather').fetchone()[0]
+    db.close()
+    return {'rows': n}
+
+
+def validate_file(fn, chunk_size):
+    r = {'rows': 0, 'nan': 0, 'unsorted': 0}
+    last = None
+    for arr in query.iter_chunks(fn, chunk_size):
+        r['rows'] += len(arr)
+        bad = numpy.zeros(len(arr), dtype=bool)
+        for n, t in logger.row_dtype:
+            if t == float:
+                bad |= numpy.isnan(arr[n])
+        r['nan'] += int(numpy.count_nonzero(bad))
+        ts = arr['Timestamp']
+        if last is not None and len(ts):
+            ts = numpy.concatenate(([last, ], ts))
+        r['unsorted'] += int(numpy.count_nonzero(numpy.diff(ts) < 0))
+        if len(ts):
+            last = ts[-1]
+    return r
+
+
+def rollup_file(fn, chunk_size):
+    # buckets are returned and merged into the rollup tables by the parent
+    buckets = dict([(res, []) for res in rollup.resolutions])
+    n = 0
+    for arr in query.iter_chunks(fn, chunk_size):
+        n += len(arr)
+        for res in rollup.resolutions:
+            buckets[res].append(rollup.aggregate(arr, res))
+    return {'rows': n, 'buckets': dict([
+        (res, numpy.concatenate(bs) if len(bs) else
+         numpy.empty(0, dtype=rollup.agg_dtype))
+        for (res, bs) in buckets.items()])}
+
+
+def archive_file(fn, chunk_size, fmt='npz'):
+    if archive.find(fn) is not None or not os.path.exists(fn):
+        return {'rows': 0}
+    path = archive.compact(fn, fmt)
+    return {'rows': len(archive.load(path, columns=['Timestamp', ]))}
+
+
+def process_file(args):
+    task, fn, chunk_size, fmt = args
+    t0 = time.monotonic()
+    if task == 'index':
+        r = index_file(fn, chunk_size)
+    elif task == 'validate':
+        r = validate_file(fn, chunk_size)
+    elif task == 'rollup':
+        r = rollup_file(fn, chunk_size)
+    elif task == 'archive':
+        r = archive_file(fn, chunk_size, fmt)
+    else:
+        raise ValueError("Unknown task %s" % task)
+    r['time'] = time.monotonic() - t0
+    return fn, r
+
+
+class Checkpoint:
+    # files completed by a task, a file is redone if it was modified
+    def __init__(self, data_dir, task, restart=False):
+        self.fn = os.path.join(
+            os.path.expanduser(data_dir), '.backfill_%s.json' % task)
+        self.done = {}
+        if restart and os.path.exists(self.fn):
+            os.remove(self.fn)
+        if os.path.exists(self.fn):
+            with open(self.fn, 'r') as f:
+                self.done = json.load(f)
+
+    @property
+    def resumed(self):
+        return len(self.done) > 0
+
+    def mtime(self, fn):
+        path = fn if os.path.exists(fn) else archive.find(fn)
+        if path is None:
+            return None
+        return os.path.getmtime(path)
+
+    def is_done(self, fn):
+        return fn in self.done and self.done[fn] == self.mtime(fn)
+
+    def mark(self, fn):
+        self.done[fn] = self.mtime(fn)
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.done, f)
+        os.rename(tmp, self.fn)
+
+    def clear(self):
+        self.done = {}
+        if os.path.exists(self.fn):
+            os.remove(self.fn)
+
+
+def run(
+        data_dir, task, processes=None, chunk_size=100000, max_memory=None,
+        restart=False, verbose=True, fmt='npz'):
+    # fmt is the archive format for the archive task
+    if task not in tasks:
+        raise ValueError("Unknown task %s" % task)
+    if task == 'archive':
+        # the newest file may still be open, and files for future
+        # periods may have been opened ahead of time
+        fns = query.find_files(data_dir, end=datetime.datetime.now())[:-1]
+    else:
+        fns = query.find_files(data_dir)
+    checkpoint = Checkpoint(data_dir, task, restart)
+
+    rollup_db = None
+    if task == 'rollup':
+        rollup_db = sqlite3.connect(rollup.get_path(data_dir))
+        rollup.create_tables(rollup_db)
+        if not checkpoint.resumed:
+            rollup.clear_tables(rollup_db)
+
+    todo = [fn for fn in fns if not checkpoint.is_done(fn)]
+    results = {}
+    t0 = time.monotonic()
+    # workers are forked once, here, and are not replaced as forking
+    # from the pool's threads while this thread is in sqlite (merging
+    # rollups) can copy a held sqlite lock into the worker, for the same
+    # reason close any loggers (and their threads) before calling run
+    # files are read in chunks so workers stay within max_memory
+    with multiprocessing.Pool(
+            processes, initializer=limit_memory,
+            initargs=(max_memory, )) as pool:
+        for (i, (fn, r)) in enumerate(pool.imap_unordered(
+                process_file, [
+                    (task, fn, chunk_size, fmt) for fn in todo])):
+            if rollup_db is not None:
+                # replaces what an earlier (interrupted) run merged
+                buckets = r.pop('buckets')
+                rollup.replace_file(rollup_db, fn, dict([
+                    (res, b.tolist()) for (res, b) in buckets.items()]))
+            checkpoint.mark(fn)
+            results[fn] = r
+            if verbose:
+                elapsed = time.monotonic() - t0
+                print("[%i/%i] %s %s %s (%.1f s remaining)" % (
+                    i + 1, len(todo), task, fn, r,
+                    elapsed / (i + 1) * (len(todo) - i - 1)))
+    if rollup_db is not None:
+        rollup_db.close()
+    # a finished run starts over next time
+    checkpoint.clear()
+    return results
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'task', choices=tasks,
+        help="Task to run on each file")
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Data directory to process")
+    parser.add_argument(
+        '-j', '--processes', default=None, type=int,
+        help="Number of worker processes (default: number of cores)")
+    parser.add_argument(
+        '-n', '--chunk_size', default=100000, type=int,
+        help="Maximum rows read at once by a worker")
+    parser.add_argument(
+        '-m', '--max_memory', default=None, type=float,
+        help="Maximum memory (in MB) per worker")
+    parser.add_argument(
+        '-r', '--restart', action='store_true',
+        help="Ignore any checkpoint from an interrupted run")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    run(
+        cfg['data_dir'], args.task, args.processes, args.chunk_size,
+        args.max_memory, args.restart, fmt=cfg['archive'] or 'npz')
@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy
+import serial
+
+from . import ingest
+from . import logger
+from . import protocol
+from . import query
+from . import test
+
+
+def generate_lines(n, interval=2., t0=None):
+    # synthetic readings every interval seconds
+    if t0 is None:
+        t0 = datetime.datetime(2020, 1, 1)
+    lines = []
+    timestamps = []
+    for i in range(n):
+        lines.append(test.build_line(
+            Time=i * 2000, Light=i % 1000, WindDir=(i * 7) % 360,
+            WindSpd=(i % 13) * 0.5, Rain=(i % 50 == 0) * 0.2794,
+            WBTemp=20 + (i % 100) * 0.01, WBPres=101325 + i % 10,
+            WBHum=50 + (i % 20) * 0.1, ExtTemp=18 + (i % 100) * 0.01,
+            SampleIndex=i))
+        timestamps.append(t0 + datetime.timedelta(seconds=i * interval))
+    return lines, timestamps
+
+
+def percentiles(ts):
+    ts = numpy.array(ts)
+    if not len(ts):
+        return {}
+    return {
+        'p50': float(numpy.percentile(ts, 50)),
+        'p90': float(numpy.percentile(ts, 90)),
+        'p99': float(numpy.percentile(ts, 99)),
+        'max': float(ts.max()),
+        'mean': float(ts.mean()),
+    }
+
+
+def make_logger(cfg):
+    # loggers read from a mock serial port
+    original = serial.Serial
+    serial.Serial = test.MockSerial
+    try:
+        return logger.Logger(cfg)
+    finally:
+        serial.Serial = original
+
+
+def bench_from_line(n):
+    lines, timestamps = generate_lines(n)
+    r = logger.Reading()
+    t0 = time.perf_counter()
+    for (line, ts) in zip(lines, timestamps):
+        r.from_line(line, ts)
+    dt = time.perf_counter() - t0
+    return {'lines': n, 'seconds': dt, 'lines_per_second': n / dt}
+
+
+def bench_parse_row(n):
+    lines, timestamps = generate_lines(n)
+    t0 = time.perf_counter()
+    for (line, ts) in zip(lines, timestamps):
+        logger.parse_row(line, ts)
+    dt = time.perf_counter() - t0
+    return {'lines': n, 'seconds': dt, 'lines_per_second': n / dt}
+
+
+def bench_parse_lines(n, bad=False):
+    # bad adds a malformed first line
+    lines, _ = generate_lines(n)
+    if bad:
+        lines = ['garbage' + lines[0], ] + lines[1:]
+    data = '\n'.join(lines).encode('ascii')
+    t0 = time.perf_counter()
+    ingest.parse_lines(data)
+    dt = time.perf_counter() - t0
+    return {'lines': n, 'seconds': dt, 'lines_per_second': n / dt}
+
+
+def bench_decode(n):
+    # binary protocol frames
+    values = [
+        (i * 2000, 1., 90., 2.5, 0., 20., 101325., 50., 18., i)
+        for i in range(n)]
+    data = b''.join([protocol.encode(v) for v in values])
+    ts = datetime.datetime(2020, 1, 1)
+    d = protocol.FrameDecoder()
+    t0 = time.perf_counter()
+    records, _ = d.feed(data)
+    protocol.to_rows(records, ts)
+    dt = time.perf_counter() - t0
+    return {
+        'lines': n, 'seconds': dt, 'lines_per_second': n / dt,
+        'bytes_per_line': len(data) / n}
+
+
+def bench_log_line(n, data_dir, **kwargs):
+    lines, timestamps = generate_lines(n)
+    cfg = {'data_dir': data_dir, 'split_days': False}
+    cfg.update(kwargs)
+    l = make_logger(cfg)
+    # open the database before timing
+    l.check_for_split(timestamps[0])
+    t0 = time.perf_counter()
+    for (line, ts) in zip(lines, timestamps):
+        l.log_line(line, ts)
+    l.flush()
+    dt = time.perf_counter() - t0
+    l.close()
+    r = {'lines': n, 'seconds': dt, 'lines_per_second': n / dt}
+    r.update(kwargs)
+    return r
+
+
+def bench_commit_latency(n, data_dir):
+    lines, timestamps = generate_lines(n)
+    db = sqlite3.connect(os.path.join(data_dir, 'latency.sqlite'))
+    logger.create_table(db)
+    r = logger.Reading()
+    ts = []
+    for (line, t) in zip(lines, timestamps):
+        r.from_line(line, t)
+        t0 = time.perf_counter()
+        r.to_db(db)
+        ts.append(time.perf_counter() - t0)
+    db.close()
+    return percentiles(ts)
+
+
+def bench_split(n, data_dir, **kwargs):
+    cfg = {'data_dir': data_dir, 'split_days': True}
+    cfg.update(kwargs)
+    l = make_logger(cfg)
+    line = test.build_line()
+    t = datetime.datetime(2020, 1, 1)
+    l.log_line(line, t)
+    ts = []
+    for i in range(n):
+        t += datetime.timedelta(days=1)
+        # a reading just before midnight prepares the next file
+        l.log_line(line, t - datetime.timedelta(seconds=1))
+        time.sleep(0.01)
+        t0 = time.perf_counter()
+        l.check_for_split(t)
+        ts.append(time.perf_counter() - t0)
+        l.log_line(line, t)
+    l.close()
+    r = percentiles(ts)
+    r.update(kwargs)
+    return r
+
+
+def make_days(data_dir, days, rows_per_day):
+    # day files written with the bulk parser (much faster than logging)
+    lines, _ = generate_lines(rows_per_day)
+    data = '\n'.join(lines)
+    t0 = datetime.datetime(2020, 1, 1)
+    interval = 86400 // rows_per_day
+    for d in range(days):
+        day = t0 + datetime.timedelta(days=d)
+        fn = os.path.join(data_dir, day.strftime('%y%m%d') + '.sqlite')
+        ts = int(day.timestamp()) + numpy.arange(rows_per_day) * interval
+        arr, _ = ingest.parse_lines(data, ts)
+        db = sqlite3.connect(fn)
+        logger.create_table(db)
+        ingest.insert_array(db, arr)
+        db.close()
+
+
+def bench_load(days, rows_per_day, data_dir):
+    ddir = os.path.join(data_dir, 'load_%i' % days)
+    os.makedirs(ddir)
+    make_days(ddir, days, rows_per_day)
+    fns = query.find_files(ddir)
+    t0 = time.perf_counter()
+    n = 0
+    for fn in fns:
+        n += len(logger.load_file(fn))
+    dt_file = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    arr = query.load_range(ddir)
+    dt_range = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    query.load_range(ddir, columns=['Timestamp', 'WBTemp'])
+    dt_columns = time.perf_counter() - t0
+    # many small (one hour) queries, with and without a pool
+    hours = [
+        datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=i)
+        for i in range(days * 24)]
+    pool = query.ConnectionPool()
+    rates = []
+    for p in (None, pool):
+        t0 = time.perf_counter()
+        for (i, t) in enumerate(hours):
+            logger.load_file(
+                fns[i // 24], start=t, end=t + datetime.timedelta(hours=1),
+                pool=p)
+        rates.append(len(hours) / (time.perf_counter() - t0))
+    pool.close()
+    shutil.rmtree(ddir)
+    return {
+        'days': days,
+        'hour_queries_per_second': rates[0],
+        'hour_queries_per_second_pooled': rates[1],
+        'rows': n,
+        'load_file_rows_per_second': n / dt_file,
+        'load_range_rows_per_second': len(arr) / dt_range,
+        'load_range_2_columns_rows_per_second': len(arr) / dt_columns,
+    }
+
+
+def run(n=10000, splits=30, load_days=(1, 30), rows_per_day=8640):
+    data_dir = tempfile.mkdtemp()
+    try:
+        results = {
+            'meta': {
+                'time': datetime.datetime.now().isoformat(),
+                'python': sys.version,
+                'numpy': numpy.__version__,
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'n': n,
+            },
+            'from_line': bench_from_line(n),
+            'parse_row': bench_parse_row(n),
+            'parse_lines': bench_parse_lines(n),
+            'parse_lines_bad': bench_parse_lines(n, bad=True),
+            'decode': bench_decode(n),
+            'log_line': [],
+            'commit_latency': bench_commit_latency(
+                min(n, 1000), data_dir),
+            'split': [],
+            'load': [],
+        }
+        for (i, (backend, batch_size)) in enumerate([
+                ('sqlite', 1), ('sqlite', 100), ('binary', 1),
+                ('binary', 100)]):
+            ddir = os.path.join(data_dir, 'log_%i' % i)
+            # per row commits are slow, use fewer rows
+            results['log_line'].append(bench_log_line(
+                n if batch_size > 1 else min(n, 1000), ddir,
+                storage=backend, batch_size=batch_size))
+        for backend in ('sqlite', 'binary'):
+            ddir = os.path.join(data_dir, 'split_%s' % backend)
+            results['split'].append(bench_split(
+                splits, ddir, storage=backend))
+        for days in load_days:
+            results['load'].append(bench_load(days, rows_per_day, data_dir))
+        return results
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o', '--output', default=None, type=str,
+        help="Save results (json) to this file")
+    parser.add_argument(
+        '-n', '--lines', default=10000, type=int,
+        help="Number of lines for ingest benchmarks")
+    parser.add_argument(
+        '-s', '--splits', default=30, type=int,
+        help="Number of day rollovers to time")
+    parser.add_argument(
+        '-l', '--load_days', default='1,30', type=str,
+        help="Comma separated numbers of days for load benchmarks")
+    parser.add_argument(
+        '-r', '--rows_per_day', default=8640, type=int,
+        help="Rows per day file for load benchmarks")
+    args = parser.parse_args()
+    results = run(
+        args.lines, args.splits,
+        [int(d) for d in args.load_days.split(',')], args.rows_per_day)
+    s = json.dumps(results, indent=2)
+    if args.output is None:
+        print(s)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(s)
@@ -0,0 +1,115 @@
+import os
+
+import numpy
+
+from . import logger
+from . import query
+
+
+magic = b'PMCLBLOG'
+version = 1
+header_dtype = numpy.dtype([
+    ('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4')])
+
+
+class BinaryLogError(Exception):
+    pass
+
+
+def get_record_dtype():
+    # fixed width little endian records matching row_dtype
+    # (built on use as logger imports this module)
+    return numpy.dtype([
+        (n, '<i8' if t == int else '<f8') for (n, t) in logger.row_dtype])
+
+
+def make_header():
+    h = numpy.zeros(1, dtype=header_dtype)
+    h['magic'] = magic
+    h['version'] = version
+    h['record_size'] = get_record_dtype().itemsize
+    return h.tobytes()
+
+
+def read_header(f):
+    bs = f.read(header_dtype.itemsize)
+    if len(bs) != header_dtype.itemsize:
+        raise BinaryLogError("Missing header")
+    h = numpy.frombuffer(bs, dtype=header_dtype)[0]
+    if h['magic'] != magic:
+        raise BinaryLogError("Invalid magic %s" % h['magic'])
+    if h['version'] != version:
+        raise BinaryLogError("Unsupported version %s" % h['version'])
+    if h['record_size'] != get_record_dtype().itemsize:
+        raise BinaryLogError("Invalid record size %s" % h['record_size'])
+    return h
+
+
+def to_records(arr):
+    record_dtype = get_record_dtype()
+    rs = numpy.empty(len(arr), dtype=record_dtype)
+    for n in record_dtype.names:
+        rs[n] = arr[n]
+    return rs
+
+
+def write(fn, arr):
+    with open(fn, 'wb') as f:
+        f.write(make_header())
+        f.write(to_records(arr).tobytes())
+
+
+def count_records(fn):
+    # number of complete records, a partial record at the tail is ignored
+    n = os.path.getsize(fn) - header_dtype.itemsize
+    return max(0, n // get_record_dtype().itemsize)
+
+
+class MappedLog:
+    # read only memory mapped view of a binary log, records are expected
+    # to be in Timestamp order (as written by the logger)
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            read_header(f)
+        n = count_records(fn)
+        record_dtype = get_record_dtype()
+        if n == 0:
+            self.data = numpy.empty(0, dtype=record_dtype)
+        else:
+            self.data = numpy.memmap(
+                fn, dtype=record_dtype, mode='r',
+                offset=header_dtype.itemsize, shape=(n, ))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        # field views share the mapped pages, no data is copied
+        return self.data[name]
+
+    @property
+    def names(self):
+        return self.data.dtype.names
+
+    def index(self, start=None, end=None):
+        # binary search Timestamp for rows with start <= Timestamp < end
+        ts = self.data['Timestamp']
+        i0 = 0
+        i1 = len(ts)
+        if start is not None:
+            i0 = int(numpy.searchsorted(ts, query.to_timestamp(start), 'left'))
+        if end is not None:
+            i1 = int(numpy.searchsorted(ts, query.to_timestamp(end), 'left'))
+        return i0, max(i0, i1)
+
+    def slice(self, start=None, end=None):
+        i0, i1 = self.index(start, end)
+        return self.data[i0:i1]
+
+    def columns(self, start=None, end=None, columns=None):
+        # dict of column views for rows in [start, end)
+        if columns is None:
+            columns = self.names
+        records = self.slice(start, end)
+        return dict([(n, records[n]) for n in columns])
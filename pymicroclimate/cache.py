@@ -0,0 +1,229 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import numpy
+
+from . import archive
+from . import logger
+from . import query
+
+
+# a file is closed once the logger has moved to a newer file for grace
+# seconds (so the last rows are written), closed files never change
+grace = 60.
+
+
+def file_version(fn):
+    # mtime and size of a database file (or its archive) and its wal,
+    # changes whenever rows are written
+    path = fn
+    if not os.path.exists(fn):
+        path = archive.find(fn) or fn
+    vs = []
+    for p in (path, path + '-wal'):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        vs += [st.st_mtime_ns, st.st_size]
+    return tuple(vs)
+
+
+class ResultCache:
+    # decoded load results keyed by file, columns and time window, held
+    # in memory (lru, up to max_bytes) and for closed files also on disk
+    # in cache_dir (oldest used removed first, up to max_disk_bytes)
+    def __init__(
+            self, max_bytes=64 * 1024 * 1024, cache_dir=None,
+            max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # data_dir: (mtime, newest file start)
+        self.listings = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cache_dir = None
+        self.disk = {}
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            self.cache_dir = os.path.expanduser(cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # name: (last use, size)
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.npy'):
+                    continue
+                st = os.stat(os.path.join(self.cache_dir, name))
+                self.disk[name] = (st.st_mtime, st.st_size)
+                self.disk_bytes += st.st_size
+
+    def key(self, fn, start=None, end=None, columns=None):
+        if columns is not None:
+            columns = tuple(columns)
+        return (
+            os.path.abspath(os.path.expanduser(fn)), columns,
+            query.to_timestamp(start), query.to_timestamp(end))
+
+    def newest_start(self, data_dir):
+        # start of the newest file in data_dir, listed when it changes
+        mtime = os.stat(data_dir).st_mtime_ns
+        with self.lock:
+            listing = self.listings.get(data_dir)
+            if listing is not None and listing[0] == mtime:
+                return listing[1]
+        stems = []
+        for name in os.listdir(data_dir):
+            m = query.file_re.match(name)
+            if m is not None:
+                stems.append(m.group(1))
+        newest = None
+        if len(stems):
+            newest = query.stem_time(max(stems, key=query.stem_time))
+        with self.lock:
+            self.listings[data_dir] = (mtime, newest)
+        return newest
+
+    def is_closed(self, fn):
+        m = query.file_re.match(os.path.basename(fn))
+        if m is None:
+            return False
+        newest = self.newest_start(os.path.dirname(fn))
+        t = query.stem_time(m.group(1))
+        return (
+            newest is not None and newest > t and
+            newest.timestamp() <= time.time() - grace)
+
+    def disk_name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy'
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        if version is None and self.cache_dir is not None:
+            name = self.disk_name(key)
+            path = os.path.join(self.cache_dir, name)
+            if name in self.disk:
+                try:
+                    arr = numpy.load(path)
+                except (OSError, ValueError):
+                    arr = None
+                if arr is not None:
+                    arr.flags.writeable = False
+                    os.utime(path)
+                    with self.lock:
+                        self.disk[name] = (time.time(), self.disk[name][1])
+                        self.disk_hits += 1
+                    self.put(key, version, arr, False)
+                    return arr
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, version, arr, save=True):
+        # version is None for closed files
+        arr.flags.writeable = False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1].nbytes
+            if arr.nbytes <= self.max_bytes:
+                self.entries[key] = (version, arr)
+                self.nbytes += arr.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, a) = self.entries.popitem(last=False)
+                self.nbytes -= a.nbytes
+                self.evictions += 1
+        if save and version is None and self.cache_dir is not None:
+            self.save(key, arr)
+
+    def save(self, key, arr):
+        name = self.disk_name(key)
+        path = os.path.join(self.cache_dir, name)
+        # write to a temporary path so partial entries are never loaded
+        tmp = '%s.%i.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            numpy.save(f, arr)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            if name in self.disk:
+                self.disk_bytes -= self.disk[name][1]
+            self.disk[name] = (time.time(), size)
+            self.disk_bytes += size
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk):
+                old = min(self.disk, key=lambda n: self.disk[n][0])
+                self.disk_bytes -= self.disk.pop(old)[1]
+                try:
+                    os.remove(os.path.join(self.cache_dir, old))
+                except FileNotFoundError:
+                    pass
+
+    def load(self, fn, start=None, end=None, columns=None, pool=None):
+        # rows of one file with start <= Timestamp < end, in Timestamp
+        # order, the result is shared and read only
+        dtype = query.get_dtype(columns)
+        key = self.key(fn, start, end, columns)
+        version = None
+        if not self.is_closed(key[0]):
+            version = file_version(key[0])
+        arr = self.get(key, version)
+        if arr is not None:
+            return arr
+        names = [n for n, _ in dtype]
+        if 'Timestamp' not in names:
+            arr = logger.load_file(
+                fn, start=start, end=end, columns=['Timestamp', ] + names,
+                pool=pool)
+        else:
+            arr = logger.load_file(
+                fn, start=start, end=end, columns=names, pool=pool)
+        ts = arr['Timestamp']
+        if len(ts) and numpy.any(ts[1:] < ts[:-1]):
+            arr = arr[numpy.argsort(ts, kind='stable')]
+        out = numpy.empty(len(arr), dtype=dtype)
+        for n in names:
+            out[n] = arr[n]
+        self.put(key, version, out)
+        return out
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def create(cfg):
+    # result cache for a data directory, None if disabled
+    if not cfg.get('result_cache_mb', 0):
+        return None
+    cache_dir = cfg.get('result_cache_dir', '')
+    if not cache_dir:
+        cache_dir = os.path.join(
+            os.path.expanduser(cfg['data_dir']), 'cache')
+    return ResultCache(
+        cfg['result_cache_mb'] * 1024 * 1024, cache_dir,
+        cfg.get('result_cache_disk_mb', 1024) * 1024 * 1024)
@@ -0,0 +1,271 @@
+import argparse
+import datetime
+import os
+import random
+import struct
+import threading
+import time
+
+from . import config
+from . import logger
+
+
+# capture files are a header followed by records of: receive time
+# (unix seconds), station, data length and the raw bytes read
+magic = b'PMCLCAPT'
+version = 1
+header_struct = struct.Struct('<8sI')
+record_struct = struct.Struct('<dHI')
+
+
+class CaptureError(Exception):
+    pass
+
+
+def read_header(f):
+    data = f.read(header_struct.size)
+    if len(data) != header_struct.size:
+        raise CaptureError("Missing header")
+    m, v = header_struct.unpack(data)
+    if m != magic:
+        raise CaptureError("Invalid magic %s" % (m, ))
+    if v != version:
+        raise CaptureError("Unsupported version %s" % v)
+
+
+def read_capture(fn):
+    # yields (receive time, station, data), a partial last record
+    # (from an interrupted capture) is ignored
+    with open(os.path.expanduser(fn), 'rb') as f:
+        read_header(f)
+        while True:
+            data = f.read(record_struct.size)
+            if len(data) < record_struct.size:
+                return
+            t, station, n = record_struct.unpack(data)
+            data = f.read(n)
+            if len(data) < n:
+                return
+            yield t, station, data
+
+
+class Capture:
+    # append raw serial data with receive times to a capture file
+    def __init__(self, fn, flush_interval=1.):
+        self.fn = os.path.expanduser(fn)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.n_records = 0
+        if os.path.exists(self.fn) and os.path.getsize(self.fn):
+            self.recover()
+            self.f = open(self.fn, 'ab')
+        else:
+            self.f = open(self.fn, 'wb')
+            self.f.write(header_struct.pack(magic, version))
+        self.last_flush = time.monotonic()
+
+    def recover(self):
+        # drop a partial last record so new records stay aligned
+        end = header_struct.size
+        for (t, station, data) in read_capture(self.fn):
+            end += record_struct.size + len(data)
+            self.n_records += 1
+        if end != os.path.getsize(self.fn):
+            os.truncate(self.fn, end)
+
+    def write(self, data, t=None, station=0):
+        if not len(data):
+            return
+        if t is None:
+            t = time.time()
+        with self.lock:
+            self.f.write(record_struct.pack(t, station, len(data)))
+            self.f.write(data)
+            self.n_records += 1
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.f.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def synthetic(n=None, interval=2., t0=None, stations=1, binary=False, seed=0):
+    # yields (time, station, data) for n (or endless) plausible readings
+    # per station, as ascii lines or binary protocol frames
+    if t0 is None:
+        t0 = time.time()
+    rng = random.Random(seed)
+    i = 0
+    while n is None or i < n:
+        for station in range(stations):
+            t = t0 + i * interval
+            values = [
+                int(i * interval * 1000) & 0xFFFFFFFF,
+                max(0., 500. + rng.gauss(0, 50)),
+                rng.uniform(0, 360),
+                max(0., rng.gauss(2, 1)),
+                0.2794 * (rng.random() < 0.05),
+                20. + rng.gauss(0, 0.5),
+                101325. + rng.gauss(0, 10),
+                min(100., max(0., 50. + rng.gauss(0, 5))),
+                18. + rng.gauss(0, 0.5),
+                i,
+            ]
+            if binary:
+                # imported here as protocol depends on logger
+                from . import protocol
+                data = protocol.encode(values)
+            else:
+                data = (','.join([
+                    str(v) if ct == int else '%.4f' % v
+                    for (v, (_, ct)) in zip(values, logger.line_tokens)]) +
+                    '\r\n').encode('ascii')
+            yield t, station, data
+        i += 1
+
+
+class ReplaySerial:
+    # serial port stand in that returns captured (or synthetic) data for
+    # one station at speed times real time (None for as fast as possible)
+    # last_timestamp is the receive time of the last data returned, if
+    # retime is True receive times are shifted so replay starts now
+    def __init__(self, source, station=0, speed=None, retime=False):
+        if isinstance(source, str):
+            source = read_capture(source)
+        self.source = iter(source)
+        self.station = station
+        self.speed = speed
+        self.retime = retime
+        self.buffer = b''
+        self.eof = False
+        self.first = None
+        self.offset = 0.
+        self.last_timestamp = None
+        self.next = None
+
+    def pull(self, block=True):
+        # move the next record into the buffer, waiting until it is due
+        if self.next is None:
+            for (t, station, data) in self.source:
+                if station == self.station or self.station is None:
+                    self.next = (t, data)
+                    break
+            else:
+                self.eof = True
+                return False
+        t, data = self.next
+        if self.first is None:
+            self.first = (t, time.monotonic())
+            if self.retime:
+                self.offset = time.time() - t
+        if self.speed:
+            due = self.first[1] + (t - self.first[0]) / self.speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                if not block:
+                    return False
+                time.sleep(wait)
+        self.next = None
+        self.buffer += data
+        self.last_timestamp = datetime.datetime.fromtimestamp(t + self.offset)
+        return True
+
+    @property
+    def in_waiting(self):
+        if not len(self.buffer) and not self.eof:
+            self.pull(block=False)
+        return len(self.buffer)
+
+    def read(self, n=1):
+        if not len(self.buffer) and not self.eof:
+            self.pull()
+        data = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return data
+
+    def readline(self):
+        while b'\n' not in self.buffer and not self.eof:
+            self.pull()
+        if self.eof and not len(self.buffer):
+            # like a serial timeout, avoid spinning when polled
+            time.sleep(0.001)
+        i = self.buffer.find(b'\n') + 1
+        if i == 0:
+            i = len(self.buffer)
+        data = self.buffer[:i]
+        self.buffer = self.buffer[i:]
+        return data
+
+    def close(self):
+        self.eof = True
+
+
+def replay(lgr):
+    # log all data from the logger's replay connections
+    readers = [
+        lgr.port_reader(c, s) for (s, c) in zip(lgr.stations, lgr.conns)]
+    n = 0
+    while not all([c.eof and not len(c.buffer) for c in lgr.conns]):
+        for r in readers:
+            if r.conn.eof and not len(r.conn.buffer):
+                continue
+            lgr.read_port(r)
+            n += len(r.data)
+        lgr.check_flush()
+    lgr.flush()
+    return n
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'source', type=str,
+        help="Capture file to replay or 'synthetic'")
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Save data to data_dir")
+    parser.add_argument(
+        '-x', '--speed', default=None, type=float,
+        help="Replay at this multiple of real time (default: fast as possible)")
+    parser.add_argument(
+        '-r', '--retime', action='store_true',
+        help="Shift receive times so the replay starts now")
+    parser.add_argument(
+        '-n', '--readings', default=10000, type=int,
+        help="Number of synthetic readings per station")
+    parser.add_argument(
+        '-s', '--stations', default=1, type=int,
+        help="Number of synthetic stations")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    cfg['capture_file'] = ''
+    cfg['metrics'] = True
+    if args.source == 'synthetic':
+        # one generator per station, so no station filtering
+        conns = [
+            ReplaySerial(
+                synthetic(
+                    args.readings, seed=station,
+                    binary=cfg['protocol'] == 'binary'),
+                None, args.speed, args.retime)
+            for station in range(args.stations)]
+    else:
+        stations = set([s for (_, s, _) in read_capture(args.source)])
+        conns = [
+            ReplaySerial(args.source, station, args.speed, args.retime)
+            for station in range(max(stations, default=0) + 1)]
+    cfg['ports'] = ['replay%i' % i for i in range(len(conns))]
+    lgr = logger.Logger(cfg, conns)
+    t0 = time.monotonic()
+    n = replay(lgr)
+    dt = time.monotonic() - t0
+    print("Replayed %i bytes in %.2f s (%.0f bytes/s)" % (n, dt, n / dt))
+    print("Metrics: %s" % lgr.metrics.report())
+    lgr.close()
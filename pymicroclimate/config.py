@@ -8,13 +8,94 @@ default_fn = '~/.pymicroclimate/config.json'
 default_config = {
     'data_dir': '~/.pymicroclimate/',
     'split_days': True,
+    'split_by': 'day',
+    'prepare_interval': 10.,
+    'clustered': False,
+    'rollups': False,
+    'archive': '',
+    'archive_remove': False,
+    'storage': 'sqlite',
+    'fsync_interval': 1.,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'sqlite_cache_kb': 8192,
+    'mmap_size': 64 * 1024 * 1024,
+    'checkpoint_interval': 30.,
+    'derived': False,
+    'derived_window': 600.,
+    # recent readings are only kept (in a ring buffer of ring_size rows)
+    # when shared with other processes through ring_file, the ring is
+    # off by default so logging does not pay for an unread buffer
+    'ring_size': 8640,
+    'ring_file': '',
+    'stream': False,
+    'stream_host': '127.0.0.1',
+    'stream_port': 8090,
+    'metrics': False,
+    'metrics_host': '127.0.0.1',
+    'metrics_port': 0,
+    'metrics_interval': 60.,
+    'ui_host': '127.0.0.1',
+    'ui_port': 5000,
+    'cache_size': 64,
+    'cache_ttl': 60.,
+    'pool_size': 32,
+    'result_cache_mb': 64,
+    'result_cache_disk_mb': 1024,
+    'result_cache_dir': '',
     'port': '/dev/ttyACM0',
+    'ports': [],
+    'batch_size': 1,
+    'batch_interval': 0.,
+    'pipeline': False,
+    'queue_size': 1024,
+    'protocol': 'ascii',
+    'capture_file': '',
 }
 required_keys = ('data_dir', 'port')
 key_types = (
     ('data_dir', str),
     ('port', str),
+    ('ports', list),
     ('split_days', bool),
+    ('split_by', str),
+    ('prepare_interval', (int, float)),
+    ('clustered', bool),
+    ('rollups', bool),
+    ('archive', str),
+    ('archive_remove', bool),
+    ('storage', str),
+    ('fsync_interval', (int, float)),
+    ('journal_mode', str),
+    ('synchronous', str),
+    ('sqlite_cache_kb', int),
+    ('mmap_size', int),
+    ('checkpoint_interval', (int, float)),
+    ('derived', bool),
+    ('derived_window', (int, float)),
+    ('ring_size', int),
+    ('ring_file', str),
+    ('stream', bool),
+    ('stream_host', str),
+    ('stream_port', int),
+    ('metrics', bool),
+    ('metrics_host', str),
+    ('metrics_port', int),
+    ('metrics_interval', (int, float)),
+    ('ui_host', str),
+    ('ui_port', int),
+    ('cache_size', int),
+    ('cache_ttl', (int, float)),
+    ('pool_size', int),
+    ('result_cache_mb', int),
+    ('result_cache_disk_mb', int),
+    ('result_cache_dir', str),
+    ('batch_size', int),
+    ('batch_interval', (int, float)),
+    ('pipeline', bool),
+    ('queue_size', int),
+    ('protocol', str),
+    ('capture_file', str),
 )
 
 
@@ -33,6 +114,64 @@ def verify_config(cfg):
             continue
         if not isinstance(cfg[k], t):
             raise ConfigError("%s is not %s[%s]" % (k, t, type(cfg[k])))
+    if cfg.get('split_by', 'day') not in ('hour', 'day', 'week'):
+        raise ConfigError("Invalid split %s" % cfg['split_by'])
+    if cfg.get('archive', '') not in ('', 'npz', 'cols', 'bin'):
+        raise ConfigError("Invalid archive format %s" % cfg['archive'])
+    if cfg.get('storage', 'sqlite') not in ('sqlite', 'binary'):
+        raise ConfigError("Invalid storage backend %s" % cfg['storage'])
+    if cfg.get('journal_mode', 'wal') not in ('wal', 'delete', 'truncate'):
+        raise ConfigError("Invalid journal mode %s" % cfg['journal_mode'])
+    if cfg.get('synchronous', 'normal') not in ('off', 'normal', 'full'):
+        raise ConfigError("Invalid synchronous %s" % cfg['synchronous'])
+    if cfg.get('derived', False) and cfg.get('storage', 'sqlite') != 'sqlite':
+        raise ConfigError("Derived metrics require sqlite storage")
+    if cfg.get('derived', False) and cfg.get('archive_remove', False):
+        raise ConfigError(
+            "Derived metrics are not archived, disable archive_remove")
+    if cfg.get('protocol', 'ascii') not in ('ascii', 'binary', 'auto'):
+        raise ConfigError("Invalid protocol %s" % cfg['protocol'])
+    if cfg.get('pipeline', False) and cfg.get('protocol', 'ascii') != 'ascii':
+        raise ConfigError("The pipeline requires the ascii protocol")
+    for p in cfg.get('ports', []):
+        if not isinstance(p, str):
+            raise ConfigError("port %s is not %s[%s]" % (p, str, type(p)))
+        try:
+            parse_port(p)
+        except ValueError:
+            raise ConfigError("Invalid station id in port %s" % p)
+    stations = get_stations(cfg)
+    if len(set(stations)) != len(stations):
+        raise ConfigError("Duplicate station ids %s" % (stations, ))
+
+
+def parse_port(p):
+    # ports can be given as path=station to set the station id, otherwise
+    # the id is the index of the port (which for --all_ports depends on
+    # the order devices were found and can change between reboots)
+    port, sep, station = p.rpartition('=')
+    if not sep:
+        return p, None
+    return port, int(station)
+
+
+def get_ports(cfg):
+    # list of ports to log
+    if len(cfg.get('ports', [])):
+        return [parse_port(p)[0] for p in cfg['ports']]
+    return [parse_port(cfg['port'])[0], ]
+
+
+def get_stations(cfg):
+    # station id of each port in get_ports
+    ports = cfg.get('ports', [])
+    if not len(ports):
+        ports = [cfg.get('port', ''), ]
+    stations = []
+    for (i, p) in enumerate(ports):
+        station = parse_port(p)[1]
+        stations.append(i if station is None else station)
+    return stations
 
 
 def load_config(fn=None):
@@ -64,8 +203,68 @@ def from_cmdline():
         '-o', '--one_file', action='store_true',
         help="Enabling this saves all data to one file")
     parser.add_argument(
-        '-p', '--port', default=None, type=str,
-        help="Serial port of weatherbit, if not provided first one will be used")
+        '--split_by', default=None, choices=('hour', 'day', 'week'),
+        help="Start a new file every hour, day or week")
+    parser.add_argument(
+        '-C', '--clustered', action='store_true',
+        help="Store new database files in Timestamp order (without rowid)")
+    parser.add_argument(
+        '-r', '--rollups', action='store_true',
+        help="Keep 1 minute, 1 hour and 1 day rollups of the data")
+    parser.add_argument(
+        '-A', '--archive', default=None, choices=('npz', 'cols', 'bin'),
+        help="Archive closed database files to this columnar format")
+    parser.add_argument(
+        '-s', '--storage', default=None, choices=('sqlite', 'binary'),
+        help="Storage backend for new database files")
+    parser.add_argument(
+        '-R', '--ring_file', default=None, type=str,
+        help="Share recent readings with other processes through this file "
+             "(off by default)")
+    parser.add_argument(
+        '-S', '--stream', action='store_true',
+        help="Publish readings as server-sent events")
+    parser.add_argument(
+        '--stream_port', default=None, type=int,
+        help="Port to publish readings on")
+    parser.add_argument(
+        '-M', '--metrics', action='store_true',
+        help="Collect metrics and periodically print a summary")
+    parser.add_argument(
+        '--metrics_port', default=None, type=int,
+        help="Serve prometheus metrics at /metrics on this port")
+    parser.add_argument(
+        '-D', '--derived', action='store_true',
+        help="Compute and store derived metrics (dew point, rain rate...)")
+    parser.add_argument(
+        '-p', '--port', default=None, type=str, action='append',
+        help=(
+            "Serial port of weatherbit, if not provided first one will be "
+            "used. Provide more than once to log several stations, use "
+            "port=id (e.g. a /dev/serial/by-id path) for stable station ids"))
+    parser.add_argument(
+        '-a', '--all_ports', action='store_true',
+        help=(
+            "Log all weatherbits found, station ids follow the order ports "
+            "are found and can change between reboots"))
+    parser.add_argument(
+        '-b', '--batch_size', default=None, type=int,
+        help="Write readings to the database in batches of this size")
+    parser.add_argument(
+        '-t', '--batch_interval', default=None, type=float,
+        help="Write batched readings at least every this many seconds")
+    parser.add_argument(
+        '-P', '--pipeline', action='store_true',
+        help="Read serial and write to the database in separate threads")
+    parser.add_argument(
+        '-B', '--protocol', default=None, choices=('ascii', 'binary', 'auto'),
+        help="Serial protocol, auto accepts both ascii lines and binary frames")
+    parser.add_argument(
+        '--capture', default=None, type=str,
+        help="Also save raw serial data with receive times to this file")
+    parser.add_argument(
+        '-q', '--queue_size', default=None, type=int,
+        help="Maximum number of lines queued between reader and writer")
     args = parser.parse_args()
 
     cfg = load_config(fn=args.config)
@@ -73,12 +272,51 @@ def from_cmdline():
         cfg['data_dir'] = args.data_dir
     if args.one_file:
         cfg['split_days'] = False
-    if args.port is None:
+    if args.split_by is not None:
+        cfg['split_by'] = args.split_by
+    if args.clustered:
+        cfg['clustered'] = True
+    if args.rollups:
+        cfg['rollups'] = True
+    if args.archive is not None:
+        cfg['archive'] = args.archive
+    if args.storage is not None:
+        cfg['storage'] = args.storage
+    if args.ring_file is not None:
+        cfg['ring_file'] = args.ring_file
+    if args.derived:
+        cfg['derived'] = True
+    if args.stream:
+        cfg['stream'] = True
+    if args.stream_port is not None:
+        cfg['stream_port'] = args.stream_port
+    if args.metrics:
+        cfg['metrics'] = True
+    if args.metrics_port is not None:
+        cfg['metrics'] = True
+        cfg['metrics_port'] = args.metrics_port
+    if args.pipeline:
+        cfg['pipeline'] = True
+    if args.protocol is not None:
+        cfg['protocol'] = args.protocol
+    if args.capture is not None:
+        cfg['capture_file'] = args.capture
+    if args.queue_size is not None:
+        cfg['queue_size'] = args.queue_size
+    if args.batch_size is not None:
+        cfg['batch_size'] = args.batch_size
+    if args.batch_interval is not None:
+        cfg['batch_interval'] = args.batch_interval
+    if args.port is not None:
+        cfg['ports'] = args.port
+    elif args.all_ports or not len(cfg['ports']):
         ports = sorted(glob.glob("/dev/ttyACM*"))
         if len(ports) == 0:
             raise IOError("No ports found")
-        cfg['port'] = ports[0]
-    else:
-        cfg['port'] = args.port
+        if args.all_ports:
+            cfg['ports'] = ports
+        else:
+            cfg['ports'] = ports[:1]
+    cfg['port'] = cfg['ports'][0]
     verify_config(cfg)
     return cfg
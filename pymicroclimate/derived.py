@@ -0,0 +1,186 @@
+import collections
+import contextlib
+import math
+import os
+
+import numpy
+
+from . import logger
+from . import query
+
+
+derived_dtype = [
+    ('Timestamp', int),
+    ('Station', int),
+    ('DewPoint', float),
+    ('RainRate', float),
+    ('WindGust', float),
+    ('WindAvgSpd', float),
+    ('WindAvgDir', float),
+    ('TempMean', float),
+    ('TempStd', float),
+    ('TempMin', float),
+    ('TempMax', float),
+]
+
+
+def create_table(db):
+    with db:
+        db.execute(
+            "create table if not exists derived(%s)" % ', '.join([
+                '%s %s' % (n, 'integer' if t == int else 'float')
+                for (n, t) in derived_dtype]))
+        db.execute(
+            "create index if not exists derived_Timestamp "
+            "on derived(Timestamp)")
+
+
+def dew_point(temperature, humidity):
+    # Magnus formula, temperature in C, relative humidity in %
+    if humidity <= 0:
+        return math.nan
+    a = 17.62
+    b = 243.12
+    g = math.log(humidity / 100.) + a * temperature / (b + temperature)
+    return b * g / (a - g)
+
+
+class SlidingStats:
+    # mean, variance (Welford), min, max and sum of values in the last
+    # window seconds with O(1) amortized work per value
+    def __init__(self, window):
+        self.window = window
+        self.values = collections.deque()
+        self.mins = collections.deque()
+        self.maxs = collections.deque()
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.sum = 0.
+
+    def add(self, t, v):
+        self.values.append((t, v))
+        self.sum += v
+        self.n += 1
+        d = v - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (v - self.mean)
+        while len(self.mins) and self.mins[-1][1] > v:
+            self.mins.pop()
+        self.mins.append((t, v))
+        while len(self.maxs) and self.maxs[-1][1] < v:
+            self.maxs.pop()
+        self.maxs.append((t, v))
+        self.expire(t)
+
+    def expire(self, t):
+        t0 = t - self.window
+        while len(self.values) and self.values[0][0] <= t0:
+            _, v = self.values.popleft()
+            self.sum -= v
+            self.n -= 1
+            if self.n == 0:
+                self.mean = 0.
+                self.m2 = 0.
+                self.sum = 0.
+            else:
+                d = v - self.mean
+                self.mean -= d / self.n
+                self.m2 -= d * (v - self.mean)
+        while len(self.mins) and self.mins[0][0] <= t0:
+            self.mins.popleft()
+        while len(self.maxs) and self.maxs[0][0] <= t0:
+            self.maxs.popleft()
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return 0.
+        return math.sqrt(max(self.m2, 0.) / (self.n - 1))
+
+    @property
+    def min(self):
+        return self.mins[0][1] if len(self.mins) else math.nan
+
+    @property
+    def max(self):
+        return self.maxs[0][1] if len(self.maxs) else math.nan
+
+
+class StationMetrics:
+    def __init__(self, window, temperature='WBTemp'):
+        self.window = window
+        self.temperature = temperature
+        self.rain = SlidingStats(window)
+        self.wind = SlidingStats(window)
+        self.wind_u = SlidingStats(window)
+        self.wind_v = SlidingStats(window)
+        self.temp = SlidingStats(window)
+
+
+class Derived:
+    # incrementally compute derived quantities per station over a sliding
+    # window (in seconds) of readings
+    def __init__(self, window=600., temperature='WBTemp'):
+        self.window = window
+        self.temperature = temperature
+        self.stations = {}
+        self.index = dict([
+            (n, i) for (i, (n, _)) in enumerate(logger.row_dtype)])
+
+    def update(self, row):
+        i = self.index
+        t = row[i['Timestamp']]
+        station = row[i['Station']]
+        m = self.stations.get(station)
+        if m is None:
+            m = StationMetrics(self.window, self.temperature)
+            self.stations[station] = m
+        m.rain.add(t, row[i['Rain']])
+        spd = row[i['WindSpd']]
+        a = math.radians(row[i['WindDir']])
+        m.wind.add(t, spd)
+        m.wind_u.add(t, spd * math.cos(a))
+        m.wind_v.add(t, spd * math.sin(a))
+        m.temp.add(t, row[i[self.temperature]])
+        return [
+            t, station,
+            dew_point(row[i['WBTemp']], row[i['WBHum']]),
+            # rain rate in per hour units
+            m.rain.sum * 3600. / self.window,
+            m.wind.max,
+            math.hypot(m.wind_u.mean, m.wind_v.mean),
+            math.degrees(math.atan2(m.wind_v.mean, m.wind_u.mean)) % 360,
+            m.temp.mean,
+            m.temp.std,
+            m.temp.min,
+            m.temp.max,
+        ]
+
+
+def load_file(fn, start=None, end=None):
+    # files written without derived metrics have no derived table
+    where, args = query.time_filter(start, end)
+    with contextlib.closing(query.connect(fn)) as db:
+        cur = db.cursor()
+        cur.execute(
+            "select count(*) from sqlite_master "
+            "where type = 'table' and name = 'derived'")
+        if not cur.fetchone()[0]:
+            return numpy.empty(0, dtype=derived_dtype)
+        cur.execute(
+            'select %s from derived%s order by Timestamp' % (
+                ', '.join([n for n, _ in derived_dtype]), where), args)
+        return numpy.array(cur.fetchall(), dtype=derived_dtype)
+
+
+def load_range(data_dir, start=None, end=None):
+    # archives only hold the weather table, files removed after archiving
+    # are skipped
+    arrs = [
+        load_file(fn, start, end)
+        for fn in query.find_files(data_dir, start, end)
+        if os.path.exists(fn)]
+    if not len(arrs):
+        return numpy.empty(0, dtype=derived_dtype)
+    return numpy.concatenate(arrs)
@@ -0,0 +1,125 @@
+import datetime
+
+import numpy
+
+from . import logger
+
+
+def _to_timestamps(timestamp, n):
+    if isinstance(timestamp, datetime.datetime):
+        timestamp = int(timestamp.timestamp())
+    ts = numpy.asarray(timestamp, dtype='i8')
+    if ts.ndim == 0:
+        return numpy.full(n, ts, dtype='i8')
+    if len(ts) != n:
+        raise ValueError(
+            "Number of timestamps[%s] does not match lines[%s]" %
+            (len(ts), n))
+    return ts
+
+
+# bytes that can appear in a line of numbers (including nan and inf),
+# 0 pads shorter lines in a numpy bytes array
+_valid_bytes = numpy.zeros(256, dtype=bool)
+_valid_bytes[list(b'0123456789+-.,eE \tnaifyNAIFY\0')] = True
+
+# lines that fail to parse are split into blocks of this many lines,
+# lines in blocks that still fail are parsed one at a time
+_block_size = 64
+
+
+def _valid_chars(lines):
+    # mask of lines that only contain bytes in _valid_bytes
+    if not len(lines) or lines.dtype.itemsize == 0:
+        return numpy.ones(len(lines), dtype=bool)
+    chars = numpy.ascontiguousarray(lines).view('u1').reshape(len(lines), lines.dtype.itemsize)
+    return _valid_bytes[chars].all(axis=1)
+
+
+def _load_block(lines, values, ok, start, end):
+    # parse lines[start:end] into values, bisecting around bad lines so
+    # one bad line does not make every line take the slow path
+    try:
+        values[start:end] = numpy.loadtxt(
+            lines[start:end].tolist(), delimiter=',', comments=None,
+            ndmin=2)
+        return
+    except ValueError:
+        pass
+    if end - start > _block_size:
+        mid = (start + end) // 2
+        _load_block(lines, values, ok, start, mid)
+        _load_block(lines, values, ok, mid, end)
+        return
+    for i in range(start, end):
+        try:
+            values[i] = numpy.array(lines[i].split(b',')).astype('f8')
+        except ValueError:
+            ok[i] = False
+
+
+def _parse_values(lines):
+    # parse a 1d array of lines into a (n lines, n tokens) float array
+    # and boolean mask of lines that parsed
+    n_tokens = len(logger.line_tokens)
+    ok = _valid_chars(lines)
+    values = numpy.zeros((len(lines), n_tokens))
+    if numpy.any(ok):
+        sub = numpy.zeros((numpy.count_nonzero(ok), n_tokens))
+        sub_ok = numpy.ones(len(sub), dtype=bool)
+        _load_block(lines[ok], sub, sub_ok, 0, len(sub))
+        values[ok] = sub
+        ok[ok] = sub_ok
+    return values, ok
+
+
+def parse_lines(data, timestamp=0, station=0):
+    # parse a buffer of comma separated lines to an array of row_dtype
+    # timestamp can be a single value or one per line in data
+    # returns the array and number of rejected (malformed) lines
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    lines = numpy.array(data.splitlines(), dtype='S')
+    ts = _to_timestamps(timestamp, len(lines))
+    lines = numpy.char.strip(lines)
+
+    # skip blank and comment lines
+    keep = numpy.char.str_len(lines) > 0
+    keep[keep] = ~numpy.char.startswith(lines[keep], b'#')
+    n_lines = numpy.count_nonzero(keep)
+
+    # reject lines with the wrong number of tokens or invalid values
+    good = keep.copy()
+    good[keep] = (
+        numpy.char.count(lines[keep], b',') == len(logger.line_tokens) - 1)
+    values, ok = _parse_values(lines[good])
+    for (i, (n, t)) in enumerate(logger.line_tokens):
+        if t == int:
+            ok &= numpy.mod(values[:, i], 1) == 0
+    good[good] = ok
+    values = values[ok]
+
+    arr = numpy.empty(len(values), dtype=logger.row_dtype)
+    arr['Timestamp'] = ts[good]
+    for (i, (n, _)) in enumerate(logger.line_tokens):
+        arr[n] = values[:, i]
+    arr['Station'] = station
+    return arr, n_lines - len(arr)
+
+
+def parse_file(fn, timestamp=0, station=0):
+    with open(fn, 'rb') as f:
+        return parse_lines(f.read(), timestamp, station)
+
+
+def insert_array(db, arr):
+    logger.insert_rows(db, arr.tolist())
+
+
+def ingest_file(fn, db, timestamp=0, station=0):
+    # parse a raw serial capture and insert it into db
+    # returns the number of inserted and rejected lines
+    arr, n_rejected = parse_file(fn, timestamp, station)
+    logger.create_table(db)
+    insert_array(db, arr)
+    return len(arr), n_rejected
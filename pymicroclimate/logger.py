@@ -1,12 +1,24 @@
+import concurrent.futures
 import datetime
 import logging
 import os
+import selectors
 import sqlite3
+import time
 
 import numpy
 import serial
 
+from . import archive
+from . import capture
 from . import config
+from . import derived
+from . import metrics
+from . import pipeline
+from . import query
+from . import ring
+from . import storage
+from . import stream
 
 
 line_tokens = [
@@ -21,10 +33,20 @@ line_tokens = [
     ('ExtTemp', float),
     ('SampleIndex', int)
 ]
-row_dtype = [('Timestamp', int), ] + line_tokens
+row_dtype = [('Timestamp', int), ] + line_tokens + [('Station', int), ]
+schema_version = 2
 
 
-def create_table(db):
+def table_columns(db, table='weather'):
+    cur = db.cursor()
+    cur.execute("pragma table_info(%s)" % table)
+    return [r[1] for r in cur.fetchall()]
+
+
+def create_table(db, clustered=False):
+    # clustered tables store rows in Timestamp order (without rowid),
+    # this only applies to new tables, existing tables are upgraded
+    # in place but keep their layout
     cur = db.cursor()
     with db:
         cur.execute("""
@@ -39,116 +61,563 @@ def create_table(db):
             WBPres float,
             WBHum float,
             ExtTemp float,
-            SampleIndex integer)
-        """)
+            SampleIndex integer,
+            Station integer default 0%s)%s
+        """ % ((
+            ',\n            primary key (Timestamp, Station, SampleIndex)',
+            ' without rowid') if clustered else ('', '')))
+        upgrade_table(db)
+
+
+def is_clustered(db):
+    cur = db.cursor()
+    cur.execute("select sql from sqlite_master where name = 'weather'")
+    return 'without rowid' in cur.fetchone()[0]
+
+
+def upgrade_table(db):
+    cur = db.cursor()
+    cur.execute("pragma user_version")
+    version = cur.fetchone()[0]
+    if version >= schema_version:
+        return
+    # version 1: multi-station logging
+    if 'Station' not in table_columns(db):
+        cur.execute(
+            "alter table weather add column Station integer default 0")
+    # version 2: index Timestamp for time range queries
+    if not is_clustered(db):
+        cur.execute(
+            "create index if not exists weather_Timestamp "
+            "on weather(Timestamp)")
+    cur.execute("pragma user_version = %i" % schema_version)
+
+
+def select_columns(db, columns=None):
+    # select expression for columns, filling in any missing from old files
+    if columns is None:
+        columns = [n for n, _ in row_dtype]
+    # pooled connections cache the columns (see query.ConnectionPool)
+    existing = getattr(db, 'weather_columns', None)
+    if existing is None:
+        existing = table_columns(db)
+    return ', '.join([
+        n if n in existing else '0 as %s' % n for n in columns])
+
+
+def insert_rows(db, rows, table='weather'):
+    if not len(rows):
+        return
+    cur = db.cursor()
+    with db:
+        # replace duplicate readings in clustered tables
+        cur.executemany(
+            "insert or replace into %s values (%s)" % (
+                table, ', '.join(['?', ] * len(rows[0]))), rows)
 
 
 class ReadingError(Exception):
     pass
 
 
+row_names = [n for n, _ in row_dtype]
+converters = [t for _, t in line_tokens]
+
+
+def parse_row(line, timestamp, station=0):
+    # row tuple (in row_dtype order) for a line, without building a Reading
+    tks = line.strip().split(',')
+    if len(tks) != len(converters):
+        raise ReadingError(
+            "Invalid number of tokens on line[%s]" % len(tks))
+    return (int(timestamp.timestamp()), ) + tuple([
+        c(v) for (c, v) in zip(converters, tks)]) + (station, )
+
+
 class Reading:
+    # compatibility wrapper around a row, see parse_row
+    __slots__ = ('data', )
+
     def __init__(self, data=None):
         if data is None:
             data = {}
         self.data = data
-    
-    def from_line(self, line, timestamp):
-        tks = line.strip().split(',')
-        if len(tks) != len(line_tokens):
-            raise ReadingError(
-                "Invalid number of tokens on line[%s]" % len(tks))
-        self.data['Timestamp'] = int(timestamp.timestamp())
-        for (v, tk) in zip(tks, line_tokens):
-            n, t = tk
-            self.data[n] = t(v)
+
+    def from_line(self, line, timestamp, station=0):
+        self.data.update(zip(row_names, parse_row(line, timestamp, station)))
+
+    def to_row(self):
+        return [self.data[k] for k in row_names]
 
     def to_db(self, db):
-        cur = db.cursor()
-        with db:
-            vs = [self.data['Timestamp'], ]
-            vs += [self.data[k] for k, _ in line_tokens]
-            cur.execute("""
-            insert into weather values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, vs)
+        # db can be a sqlite connection or a storage backend
+        if hasattr(db, 'write'):
+            db.write([self.to_row(), ])
+        else:
+            insert_rows(db, [self.to_row(), ])
 
     def __repr__(self):
         return "Reading(%s)" % (self.data, )
 
 
+class BatchWriter:
+    # buffer rows and write them to a storage backend in one transaction
+    # when batch_size rows are buffered or batch_interval seconds have
+    # passed (<= 0 disables)
+    def __init__(
+            self, storage, batch_size=1, batch_interval=0., table='weather'):
+        self.storage = storage
+        self.table = table
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def is_due(self):
+        if len(self.rows) >= self.batch_size:
+            return True
+        if self.batch_interval <= 0:
+            return False
+        return time.monotonic() - self.last_flush >= self.batch_interval
+
+    def write(self, row):
+        self.rows.append(row)
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not len(self.rows):
+            return
+        self.storage.write(self.rows, self.table)
+        self.rows = []
+
+
+class PortReader:
+    # split bytes read from one station's serial port into lines, and
+    # binary frames (into records) if a decoder is provided
+    def __init__(self, conn, station, decoder=None):
+        self.conn = conn
+        self.station = station
+        self.buffer = b''
+        self.decoder = decoder
+        self.records = None
+        self.data = b''
+
+    def feed(self, data):
+        if self.decoder is not None:
+            self.records, lines = self.decoder.feed(data)
+            return lines
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return lines
+
+    def read(self):
+        self.data = self.conn.read(max(1, self.conn.in_waiting))
+        return self.feed(self.data)
+
+
 class Logger:
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, conns=None):
         self.cfg = config.load_config(cfg)
-        self.conn = serial.Serial(self.cfg['port'], 115200)
+        # station ids default to the index of the port in cfg['ports']
+        self.ports = config.get_ports(self.cfg)
+        self.stations = config.get_stations(self.cfg)
+        # conns can be provided (one per port), see capture.ReplaySerial
+        if conns is None:
+            conns = [serial.Serial(p, 115200) for p in self.ports]
+        self.conns = conns
+        self.conn = self.conns[0]
+        self.capture = None
+        if self.cfg['capture_file']:
+            self.capture = capture.Capture(self.cfg['capture_file'])
+        self.selector = None
+        self.metrics = metrics.create(self.cfg)
+        self.last_report = time.monotonic()
+        self.storage = None
+        # sqlite connection when using sqlite storage
         self.db = None
+        self.db_fn = None
+        # start of the current file period, and the time after which
+        # check_for_split needs to split or prepare the next file
         self.db_ts = None
+        self.split_end = None
+        self.split_at = datetime.datetime.min
+        # next file opened ahead of time and files being finalized
+        self.executor = None
+        self.next = None
+        self.pending = []
+        self.writer = None
+        self.derived = None
+        self.derived_writer = None
+        if self.cfg['derived']:
+            self.derived = derived.Derived(self.cfg['derived_window'])
+        self.rollups = None
+        if self.cfg['rollups']:
+            self.open_rollups()
+        self.ring = None
+        if self.cfg['ring_size'] > 0 and self.cfg['ring_file']:
+            self.open_ring()
+        self.publisher = None
+        if self.cfg['stream']:
+            self.publisher = stream.Publisher()
+            self.publisher.serve(
+                self.cfg['stream_host'], self.cfg['stream_port'])
 
-    def split(self, ts):
-        # new db file
+    def open_ring(self):
+        # share recent readings with other processes
+        self.ring = ring.RingBuffer(
+            self.cfg['ring_size'], os.path.expanduser(self.cfg['ring_file']))
+
+    def latest(self, n=None):
+        if self.ring is None:
+            return None
+        return self.ring.get(n)
+
+    def open_rollups(self):
+        # imported here as rollup depends on this module
+        from . import rollup
+        db = sqlite3.connect(
+            rollup.get_path(self.cfg['data_dir']), check_same_thread=False)
+        storage.configure(db, self.cfg)
+        self.rollups = rollup.Rollups(db)
+
+    def flush(self):
+        for w in (self.writer, self.derived_writer):
+            if w is not None:
+                w.flush()
+        if self.storage is not None:
+            self.storage.flush()
+        self.wait()
+
+    def wait(self):
+        # wait for previous files to be finalized
+        for f in self.pending:
+            f.result()
+        self.pending = []
+
+    def check_flush(self):
+        for w in (self.writer, self.derived_writer):
+            if w is not None and w.is_due():
+                w.flush()
+
+    def close(self):
+        self.flush()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+            self.db = None
+        self.writer = None
+        self.derived_writer = None
+        self.split_at = datetime.datetime.min
+        if self.next is not None:
+            fn, f = self.next
+            self.next = None
+            self.discard(*f.result())
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.rollups is not None:
+            self.rollups.close()
+            self.rollups = None
+        if self.ring is not None:
+            self.ring.flush()
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+        self.metrics.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def report_metrics(self):
+        # print a metrics summary every metrics_interval seconds
+        interval = self.cfg['metrics_interval']
+        if not self.metrics.enabled or interval <= 0:
+            return
+        if time.monotonic() - self.last_report < interval:
+            return
+        self.last_report = time.monotonic()
+        print("Metrics: %s" % self.metrics.report())
+
+    def background(self):
+        # one worker so files are opened and closed in order
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        return self.executor
+
+    def storage_path(self, start):
+        # file name (without extension) for the period starting at start
         ddir = os.path.expanduser(self.cfg['data_dir'])
         if ddir == ':memory:':
-            fn = ddir
+            return ddir
+        if not os.path.exists(ddir):
+            os.makedirs(ddir, exist_ok=True)
+        return os.path.join(
+            ddir, query.file_stem(start, self.cfg['split_by']))
+
+    def open_storage(self, fn):
+        # returns the storage and if the file was created by opening it
+        ext = storage.backends[self.cfg['storage']].extension
+        created = fn == ':memory:' or not os.path.exists(fn + ext)
+        return storage.open_storage(self.cfg['storage'], fn, self.cfg), created
+
+    def prepare(self, start):
+        # open the file for the next period in the background
+        fn = self.storage_path(start)
+        self.next = (fn, self.background().submit(self.open_storage, fn))
+
+    def discard(self, s, created):
+        # close an unused prepared file
+        s.close()
+        if created and s.fn != ':memory:' and os.path.exists(s.fn):
+            os.remove(s.fn)
+
+    def finalize(self, s, *writers):
+        # flush, close and optionally archive a previous file
+        try:
+            for w in writers:
+                if w is not None:
+                    w.flush()
+            s.close()
+        except Exception as e:
+            logging.error("Failed to close %s: %s", s.fn, e)
+            return
+        if self.cfg['archive'] and s.fn != ':memory:':
+            self.archive(s.fn)
+
+    def split(self, ts):
+        t0 = self.metrics.clock()
+        split = self.cfg['split_by']
+        start = query.period_start(ts, split)
+        fn = self.storage_path(start)
+        new = None
+        if self.next is not None:
+            nfn, f = self.next
+            self.next = None
+            if nfn == fn:
+                new, _ = f.result()
+            else:
+                # time jumped past the prepared file
+                self.background().submit(lambda: self.discard(*f.result()))
+        if new is None:
+            new, _ = self.open_storage(fn)
+        if self.storage is not None:
+            self.pending = [f for f in self.pending if not f.done()]
+            self.pending.append(self.background().submit(
+                self.finalize, self.storage, self.writer,
+                self.derived_writer))
+        self.storage = new
+        self.db = self.storage.db
+        self.db_fn = self.storage.fn
+        self.db_ts = start
+        if self.cfg['split_days']:
+            self.split_end = query.period_end(start, split)
+            self.split_at = max(start, self.split_end - datetime.timedelta(
+                seconds=self.cfg['prepare_interval']))
         else:
-            if not os.path.exists(ddir):
-                os.makedirs(ddir)
-            fn = os.path.join(ddir, ts.strftime('%y%m%d') + '.sqlite')
-        self.db = sqlite3.connect(fn)
-        self.db_ts = ts
-        create_table(self.db)
+            self.split_end = self.split_at = datetime.datetime.max.replace(
+                tzinfo=ts.tzinfo)
+        self.writer = BatchWriter(
+            self.storage, self.cfg['batch_size'], self.cfg['batch_interval'])
+        if self.derived is not None:
+            self.derived_writer = BatchWriter(
+                self.storage, self.cfg['batch_size'],
+                self.cfg['batch_interval'], 'derived')
+        self.metrics.split_time.observe(self.metrics.clock() - t0)
+
+    def archive(self, fn):
+        if os.path.splitext(fn)[1] == '.' + self.cfg['archive']:
+            # already stored in the archive format
+            return
+        try:
+            archive.compact(
+                fn, self.cfg['archive'], self.cfg['archive_remove'])
+        except Exception as e:
+            logging.error("Failed to archive %s: %s", fn, e)
 
     def check_for_split(self, ts):
-        if self.db is None:
+        # split_at is naive until a file is open, timestamps can be aware
+        if self.storage is None:
             return self.split(ts)
-        if not self.cfg.get('split_days', False):
+        # readings from before the current period (the clock going back)
+        # are stored in the current file
+        if ts < self.split_at:
             return
-        dbts = self.db_ts
-        if (
-                dbts.year != ts.year or
-                dbts.month != ts.month or
-                dbts.day != ts.day):
+        if ts >= self.split_end:
             return self.split(ts)
+        # the end of the period is close, get the next file ready
+        self.split_at = self.split_end
+        self.prepare(self.split_end)
 
-    def log_line(self, line, ts):
+    def log_line(self, line, ts, station=0):
         if not len(line):
             return
+        m = self.metrics
         if line[0] == '#':
+            m.lines_commented.inc()
             return
+        t0 = m.clock()
+        try:
+            row = parse_row(line, ts, station)
+        except (ReadingError, ValueError):
+            m.lines_rejected.inc()
+            raise
+        m.parse_time.observe(m.clock() - t0)
+        m.lines_parsed.inc()
+        self.log_row(row, ts)
+
+    def log_records(self, records, ts, station=0):
+        # log binary protocol records (see protocol)
+        if not len(records):
+            return
+        from . import protocol
+        m = self.metrics
+        t0 = m.clock()
+        rows = protocol.to_rows(records, ts, station)
+        m.parse_time.observe(m.clock() - t0)
+        m.lines_parsed.inc(len(rows))
+        for row in rows:
+            self.log_row(row, ts)
+
+    def log_row(self, row, ts):
         self.check_for_split(ts)
-        r = Reading()
-        r.from_line(line, ts)
-        r.to_db(self.db)
-        logging.debug("Wrote %s to database", r)
+        m = self.metrics
+        t0 = m.clock()
+        self.writer.write(row)
+        m.write_time.observe(m.clock() - t0)
+        if self.derived is not None:
+            self.derived_writer.write(self.derived.update(row))
+        if self.rollups is not None:
+            self.rollups.add(row)
+        if self.ring is not None:
+            self.ring.append(row)
+        if self.publisher is not None:
+            self.publisher.publish(row)
+        logging.debug("Wrote %s to database", row)
 
-    def parse_line(self, line, ts=None):
+    def parse_line(self, line, ts=None, station=0):
         if ts is None:
             ts = datetime.datetime.now()
-        self.log_line(line, ts)
+        self.log_line(line, ts, station)
 
-    def read_serial_line(self):
+    def log_data(self, data, ts, station=0):
+        # log one line of bytes, invalid lines (including garbage from
+        # opening a port) are counted and skipped
         try:
-            self.parse_line(self.conn.readline().decode('ascii').strip())
-        except ReadingError as e:
-            print("Invalid line: %s" % e)
+            self.parse_line(data.decode('ascii').strip(), ts, station)
+        except UnicodeDecodeError as e:
+            self.metrics.lines_rejected.inc()
+            print("Invalid line[%s]: %s" % (station, e))
+        except (ReadingError, ValueError) as e:
+            print("Invalid line[%s]: %s" % (station, e))
+
+    def receive_time(self, conn, station=0, data=b''):
+        # replayed connections provide their own receive times
+        ts = getattr(conn, 'last_timestamp', None)
+        if ts is None:
+            ts = datetime.datetime.now()
+        if self.capture is not None:
+            self.capture.write(data, ts.timestamp(), station)
+        return ts
 
+    def count_read(self, nbytes, conn, lines=1):
+        m = self.metrics
+        if not m.enabled or not nbytes:
+            return
+        m.lines_read.inc(lines)
+        m.bytes_read.inc(nbytes)
+        m.serial_backlog.set(conn.in_waiting)
+
+    def read_serial_line(self):
+        data = self.conn.readline()
+        station = self.stations[0]
+        ts = self.receive_time(self.conn, station, data)
+        self.count_read(len(data), self.conn)
+        self.log_data(data, ts, station)
+
+    def read_serial_ports(self, timeout=1.):
+        # wait for data on any port and log all complete lines
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            for (station, conn) in zip(self.stations, self.conns):
+                self.selector.register(
+                    conn, selectors.EVENT_READ,
+                    self.port_reader(conn, station))
+        for (key, _) in self.selector.select(timeout):
+            self.read_port(key.data)
+        self.check_flush()
+
+    def port_reader(self, conn, station):
+        decoder = None
+        if self.cfg['protocol'] != 'ascii':
+            # imported here as protocol depends on this module
+            from . import protocol
+            decoder = protocol.FrameDecoder(self.cfg['protocol'] == 'auto')
+        return PortReader(conn, station, decoder)
 
-def load_file(fn, as_array=True):
-    with sqlite3.connect(fn) as db:
+    def read_port(self, reader):
+        decoder = reader.decoder
+        n_bad = 0 if decoder is None else decoder.n_bad
+        lines = reader.read()
+        ts = self.receive_time(reader.conn, reader.station, reader.data)
+        if self.metrics.enabled:
+            n = len(lines)
+            if decoder is not None:
+                n += len(reader.records)
+                self.metrics.lines_rejected.inc(decoder.n_bad - n_bad)
+            self.count_read(len(reader.data), reader.conn, n)
+        for line in lines:
+            self.log_data(line, ts, reader.station)
+        if reader.records is not None:
+            self.log_records(reader.records, ts, reader.station)
+
+
+def load_file(
+        fn, as_array=True, start=None, end=None, columns=None, pool=None):
+    # pool is an optional query.ConnectionPool
+    path = archive.find(fn)
+    if path is not None:
+        arr = archive.load(path, start, end, columns)
+        if not as_array:
+            return arr.tolist()
+        return arr
+    dtype = query.get_dtype(columns)
+    with query.reader(fn, pool) as db:
         cur = db.cursor()
-        cur.execute('select * from weather')
+        where, args = query.time_filter(start, end)
+        # only order (using the Timestamp index) when filtering by time
+        cur.execute('select %s from weather%s%s' % (
+            select_columns(db, [n for n, _ in dtype]), where,
+            ' order by Timestamp' if len(args) else ''), args)
         vs = cur.fetchall()
         if not as_array:
             return vs
-        return numpy.array(vs, dtype=row_dtype)
+        return numpy.array(vs, dtype=dtype)
 
 
 def run_cmdline():
     cfg = config.from_cmdline()
     logger = Logger(cfg)
-    print("Logging %s to %s, Ctrl-C to quit" % (cfg['port'], cfg['data_dir']))
-    while True:
-        try:
-            logger.read_serial_line()
-        except KeyboardInterrupt as e:
-            print("Quitting...")
-            break
-    del logger
+    print("Logging %s to %s, Ctrl-C to quit" % (
+        ', '.join(logger.ports), cfg['data_dir']))
+    if cfg['pipeline']:
+        return pipeline.run(logger, cfg)
+    if len(logger.conns) > 1 or cfg['protocol'] != 'ascii':
+        read = logger.read_serial_ports
+    else:
+        read = logger.read_serial_line
+    # close (flushing buffered rows) whatever stops the loop
+    try:
+        while True:
+            try:
+                read()
+                logger.report_metrics()
+            except KeyboardInterrupt as e:
+                print("Quitting...")
+                break
+    finally:
+        logger.close()
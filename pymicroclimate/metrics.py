@@ -0,0 +1,228 @@
+import bisect
+import http.server
+import threading
+import time
+
+
+prefix = 'pymicroclimate_'
+# seconds, from 10 us to 10 s
+time_buckets = [
+    m * 10. ** e for e in range(-5, 1) for m in (1., 2.5, 5.)] + [10., ]
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, n=1):
+        # not locked, increments from several threads are rarely lost
+        self.value += n
+
+    def samples(self):
+        return [(self.name, '', self.value), ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, v):
+        self.value = v
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=None):
+        self.name = name
+        self.help = help_text
+        if buckets is None:
+            buckets = time_buckets
+        self.buckets = list(buckets)
+        # last count is for values above all buckets
+        self.counts = [0, ] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket containing the q quantile
+        if not self.count:
+            return 0.
+        n = q * self.count
+        total = 0
+        for (b, c) in zip(self.buckets, self.counts):
+            total += c
+            if total >= n:
+                return b
+        return float('inf')
+
+    def samples(self):
+        ss = []
+        total = 0
+        for (b, c) in zip(self.buckets, self.counts):
+            total += c
+            ss.append((self.name + '_bucket', '{le="%g"}' % b, total))
+        ss.append((self.name + '_bucket', '{le="+Inf"}', self.count))
+        ss.append((self.name + '_sum', '', self.sum))
+        ss.append((self.name + '_count', '', self.count))
+        return ss
+
+
+class NullMetric:
+    # accepts and ignores all updates
+    value = 0
+    count = 0
+    sum = 0.
+
+    def inc(self, n=1):
+        pass
+
+    def set(self, v):
+        pass
+
+    def observe(self, v):
+        pass
+
+    def quantile(self, q):
+        return 0.
+
+    def samples(self):
+        return []
+
+
+class Registry:
+    enabled = True
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+        self.thread = None
+        self.last_report = (time.monotonic(), 0)
+        self.lines_read = self.counter(
+            'lines_read_total', "Lines read from serial ports")
+        self.lines_parsed = self.counter(
+            'lines_parsed_total', "Lines parsed into readings")
+        self.lines_rejected = self.counter(
+            'lines_rejected_total', "Invalid lines")
+        self.lines_commented = self.counter(
+            'lines_commented_total', "Comment lines")
+        self.bytes_read = self.counter(
+            'bytes_read_total', "Bytes read from serial ports")
+        self.serial_backlog = self.gauge(
+            'serial_backlog_bytes', "Bytes waiting in the serial input buffer")
+        self.parse_time = self.histogram(
+            'parse_seconds', "Time to parse a line")
+        self.write_time = self.histogram(
+            'write_seconds', "Time to write (or buffer) a reading")
+        self.split_time = self.histogram(
+            'split_seconds', "Time to start a new database file")
+
+    def clock(self):
+        return time.perf_counter()
+
+    def add(self, m):
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=None):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP %s%s %s' % (prefix, m.name, m.help))
+            lines.append('# TYPE %s%s %s' % (prefix, m.name, m.kind))
+            for (n, labels, v) in m.samples():
+                lines.append('%s%s%s %s' % (prefix, n, labels, v))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        # one line summary, rates are since the previous report
+        t = time.monotonic()
+        t0, n0 = self.last_report
+        self.last_report = (t, self.bytes_read.value)
+        rate = (self.bytes_read.value - n0) / max(t - t0, 1e-9)
+        return (
+            "read %i parsed %i rejected %i commented %i %.1f bytes/s "
+            "backlog %i parse p99 %g s write p99 %g s split max %g s" % (
+                self.lines_read.value, self.lines_parsed.value,
+                self.lines_rejected.value, self.lines_commented.value,
+                rate, self.serial_backlog.value,
+                self.parse_time.quantile(0.99),
+                self.write_time.quantile(0.99),
+                self.split_time.quantile(1.)))
+
+    def serve(self, host='127.0.0.1', port=9090):
+        # serve render() at /metrics
+        handler = type('Handler', (MetricsHandler, ), {'registry': self})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.server.server_address
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class NullRegistry(Registry):
+    # used when metrics are disabled, all metrics are no-ops
+    enabled = False
+
+    def clock(self):
+        return 0.
+
+    def add(self, m):
+        return NullMetric()
+
+    def report(self):
+        return ''
+
+    def serve(self, host='127.0.0.1', port=9090):
+        return None
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create(cfg):
+    if not cfg.get('metrics', False):
+        return NullRegistry()
+    r = Registry()
+    if cfg.get('metrics_port', 0):
+        r.serve(cfg.get('metrics_host', '127.0.0.1'), cfg['metrics_port'])
+    return r
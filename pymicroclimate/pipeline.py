@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+
+from . import logger
+
+
+class Pipeline:
+    # reader threads (one per station) timestamp raw serial lines and
+    # queue them for a writer thread that parses them and writes to
+    # the database
+    def __init__(self, lgr, queue_size=1024, put_timeout=1.):
+        self.logger = lgr
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.put_timeout = put_timeout
+        self.running = threading.Event()
+        self.threads = []
+        self.n_read = 0
+        self.n_written = 0
+        self.n_invalid = 0
+        self.n_backpressured = 0
+        self.n_dropped = 0
+        # exception that stopped the writer, see check
+        self.error = None
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'read': self.n_read,
+            'written': self.n_written,
+            'invalid': self.n_invalid,
+            'backpressured': self.n_backpressured,
+            'dropped': self.n_dropped,
+        }
+
+    def enqueue(self, line, ts, station=0):
+        item = (line, ts, station)
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.n_backpressured += 1
+        # wait for the writer to catch up before dropping the line
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+
+    def read(self, index=0):
+        # index of the port in logger.conns
+        conn = self.logger.conns[index]
+        station = self.logger.stations[index]
+        line = conn.readline()
+        ts = self.logger.receive_time(conn, station, line)
+        self.logger.count_read(len(line), conn)
+        if not len(line.strip()):
+            return False
+        self.n_read += 1
+        return self.enqueue(line, ts, station)
+
+    def process(self, timeout=None):
+        try:
+            line, ts, station = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            self.logger.check_flush()
+            return False
+        try:
+            self.logger.parse_line(
+                line.decode('ascii').strip(), ts, station)
+            self.n_written += 1
+        except (logger.ReadingError, ValueError) as e:
+            self.n_invalid += 1
+            print("Invalid line: %s" % e)
+        finally:
+            self.queue.task_done()
+        return True
+
+    def _read_loop(self, index):
+        while self.running.is_set():
+            self.read(index)
+
+    def _write_loop(self):
+        try:
+            while self.running.is_set() or not self.queue.empty():
+                self.process(timeout=0.1)
+            self.logger.flush()
+        except Exception as e:
+            # storage errors stop the pipeline, readers would otherwise
+            # fill the queue and drop every line
+            self.error = e
+            self.running.clear()
+
+    def check(self):
+        # raise the error that stopped the writer
+        if self.error is not None:
+            raise self.error
+        if len(self.threads) and not self.threads[-1].is_alive():
+            raise RuntimeError("Pipeline writer stopped")
+
+    def start(self):
+        self.running.set()
+        self.threads = [
+            threading.Thread(
+                target=self._read_loop, args=(index, ), daemon=True)
+            for index in range(len(self.logger.conns))]
+        self.threads.append(
+            threading.Thread(target=self._write_loop, daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def stop(self, timeout=5.):
+        self.running.clear()
+        # readers can be stuck in a blocking readline so only
+        # wait for them briefly, the writer drains the queue
+        for reader in self.threads[:-1]:
+            reader.join(timeout=0.5)
+        if len(self.threads):
+            self.threads[-1].join(timeout=timeout)
+        self.threads = []
+
+
+def run(lgr, cfg, stats_interval=60.):
+    p = Pipeline(lgr, cfg['queue_size'])
+    p.start()
+    last_stats = time.monotonic()
+    # stop and close (flushing buffered rows) whatever stops the loop
+    try:
+        while True:
+            try:
+                time.sleep(0.5)
+                p.check()
+                if time.monotonic() - last_stats >= stats_interval:
+                    print("Pipeline: %s" % (p.stats(), ))
+                    last_stats = time.monotonic()
+                lgr.report_metrics()
+            except KeyboardInterrupt as e:
+                print("Quitting...")
+                break
+    finally:
+        p.stop()
+        lgr.close()
@@ -0,0 +1,98 @@
+import binascii
+import struct
+
+import numpy
+
+from . import logger
+
+
+# frames are: sync (2 bytes), payload length (1 byte), payload and a
+# crc16 (ccitt, init 0xffff, little endian) of the length and payload
+# see report_binary in firmware/weatherstation/weatherstation.ino
+protocols = ('ascii', 'binary', 'auto')
+sync = b'\xaa\x55'
+payload_dtype = numpy.dtype([
+    (n, '<u4' if t == int else '<f4') for (n, t) in logger.line_tokens])
+payload_size = payload_dtype.itemsize
+frame_size = len(sync) + 1 + payload_size + 2
+# drop text without a newline or sync after this many bytes
+max_buffer = 4096
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode(values):
+    # frame for values in line_tokens order (as sent by the firmware)
+    payload = numpy.array(
+        [tuple(values), ], dtype=payload_dtype).tobytes()
+    body = bytes([len(payload), ]) + payload
+    return sync + body + struct.pack('<H', crc16(body))
+
+
+def to_rows(records, timestamp, station=0):
+    # row tuples (in row_dtype order) for decoded payload records
+    ts = int(timestamp.timestamp())
+    return [(ts, ) + r + (station, ) for r in records.tolist()]
+
+
+class FrameDecoder:
+    # split a byte stream into binary frames and text lines, if text is
+    # False only comment lines are returned
+    def __init__(self, text=True):
+        self.text = text
+        self.buffer = bytearray()
+        self.n_frames = 0
+        self.n_bad = 0
+
+    def feed(self, data):
+        # returns (records, lines), records are payload_dtype
+        buf = self.buffer
+        buf += data
+        payloads = []
+        lines = []
+        i = 0
+        while i < len(buf):
+            s = buf.find(sync, i)
+            if s == i:
+                if len(buf) - i < 3:
+                    break
+                end = i + 3 + buf[i + 2] + 2
+                if len(buf) < end:
+                    break
+                body = bytes(buf[i + 2:end - 2])
+                crc = struct.unpack('<H', buf[end - 2:end])[0]
+                if len(body) - 1 != payload_size or crc16(body) != crc:
+                    # not a frame (or corrupt), resync after the sync
+                    self.n_bad += 1
+                    i += 1
+                    continue
+                payloads.append(body[1:])
+                i = end
+                continue
+            n = buf.find(b'\n', i)
+            if n != -1 and (s == -1 or n < s):
+                line = bytes(buf[i:n])
+                if not line.isascii():
+                    # remains of a corrupt frame
+                    self.n_bad += 1
+                elif self.text or line.startswith(b'#'):
+                    lines.append(line)
+                else:
+                    self.n_bad += 1
+                i = n + 1
+                continue
+            if s != -1:
+                # partial line before a frame
+                self.n_bad += 1
+                i = s
+                continue
+            if len(buf) - i > max_buffer:
+                self.n_bad += 1
+                i = len(buf)
+            break
+        del buf[:i]
+        self.n_frames += len(payloads)
+        records = numpy.frombuffer(b''.join(payloads), dtype=payload_dtype)
+        return records, lines
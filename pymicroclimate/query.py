@@ -0,0 +1,283 @@
+import collections
+import contextlib
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import urllib.request
+
+import numpy
+
+from . import archive
+from . import logger
+
+
+# files are named by the start of the period (hour, day or week) they
+# cover, hourly files include the hour
+file_re = re.compile(r'^(\d{6}(?:_\d{2})?)\.(sqlite|npz|cols|bin)$')
+splits = ('hour', 'day', 'week')
+
+
+def period_start(ts, split='day'):
+    # start of the file period containing ts, weeks start on monday
+    if split == 'hour':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    start = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if split == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def period_end(start, split='day'):
+    if split == 'hour':
+        return start + datetime.timedelta(hours=1)
+    if split == 'week':
+        return start + datetime.timedelta(days=7)
+    return start + datetime.timedelta(days=1)
+
+
+def file_stem(start, split='day'):
+    if split == 'hour':
+        return start.strftime('%y%m%d_%H')
+    return start.strftime('%y%m%d')
+
+
+def stem_time(stem):
+    if '_' in stem:
+        return datetime.datetime.strptime(stem, '%y%m%d_%H')
+    return datetime.datetime.strptime(stem, '%y%m%d')
+
+
+def connect(fn, **kwargs):
+    # read only connection, readers never block the logger
+    uri = 'file:%s?mode=ro' % urllib.request.pathname2url(
+        os.path.abspath(os.path.expanduser(fn)))
+    return sqlite3.connect(uri, uri=True, **kwargs)
+
+
+class ReaderConnection(sqlite3.Connection):
+    # pooled connection, weather_columns caches the weather table columns
+    pool_key = None
+    weather_columns = None
+
+
+class ConnectionPool:
+    # lru cache of at most size idle read only connections to database
+    # files, a connection is only used by one thread at a time and keeps
+    # its prepared statements between uses
+    def __init__(self, size=32, cached_statements=256):
+        self.size = size
+        self.cached_statements = cached_statements
+        self.idle = collections.OrderedDict()
+        self.n_idle = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, fn):
+        fn = os.path.abspath(os.path.expanduser(fn))
+        # a replaced file gets new connections
+        return (fn, os.stat(fn).st_ino)
+
+    def acquire(self, fn):
+        key = self.key(fn)
+        with self.lock:
+            dbs = self.idle.get(key)
+            if dbs:
+                self.hits += 1
+                self.n_idle -= 1
+                db = dbs.pop()
+                if not len(dbs):
+                    del self.idle[key]
+                return db
+            self.misses += 1
+        db = connect(
+            key[0], factory=ReaderConnection, check_same_thread=False,
+            cached_statements=self.cached_statements)
+        db.pool_key = key
+        db.weather_columns = logger.table_columns(db)
+        return db
+
+    def release(self, db):
+        with self.lock:
+            self.idle.setdefault(db.pool_key, []).append(db)
+            self.idle.move_to_end(db.pool_key)
+            self.n_idle += 1
+            while self.n_idle > self.size:
+                key, dbs = next(iter(self.idle.items()))
+                dbs.pop(0).close()
+                if not len(dbs):
+                    del self.idle[key]
+                self.n_idle -= 1
+                self.evictions += 1
+
+    @contextlib.contextmanager
+    def connection(self, fn):
+        db = self.acquire(fn)
+        try:
+            yield db
+        except Exception:
+            # do not reuse a connection that failed
+            db.close()
+            raise
+        self.release(db)
+
+    def close(self):
+        with self.lock:
+            for dbs in self.idle.values():
+                for db in dbs:
+                    db.close()
+            self.idle.clear()
+            self.n_idle = 0
+
+
+@contextlib.contextmanager
+def reader(fn, pool=None):
+    # read only connection from pool, or a new one closed after use
+    if pool is not None:
+        with pool.connection(fn) as db:
+            yield db
+        return
+    with contextlib.closing(connect(fn)) as db:
+        yield db
+
+
+def to_timestamp(t):
+    if t is None:
+        return None
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    if isinstance(t, datetime.date):
+        return datetime.datetime.combine(t, datetime.time()).timestamp()
+    return t
+
+
+def find_files(data_dir, start=None, end=None):
+    # find database files (named by Logger.split) that can contain data
+    # in [start, end), each file covers from its name until the next file
+    # files that were archived (and removed) are still returned
+    ddir = os.path.expanduser(data_dir)
+    start = to_timestamp(start)
+    end = to_timestamp(end)
+    fns = {}
+    for name in os.listdir(ddir):
+        m = file_re.match(name)
+        if m is None:
+            continue
+        t = stem_time(m.group(1)).timestamp()
+        fns[t] = os.path.join(ddir, m.group(1) + '.sqlite')
+    fns = sorted(fns.items())
+    selected = []
+    for (i, (t, fn)) in enumerate(fns):
+        if end is not None and t >= end:
+            break
+        if start is not None and i + 1 < len(fns) and fns[i + 1][0] <= start:
+            continue
+        selected.append(fn)
+    return selected
+
+
+def get_dtype(columns=None):
+    if columns is None:
+        return logger.row_dtype
+    types = dict(logger.row_dtype)
+    for c in columns:
+        if c not in types:
+            raise ValueError("Unknown column %s" % c)
+    return [(c, types[c]) for c in columns]
+
+
+def time_filter(start=None, end=None):
+    conditions = []
+    args = []
+    if start is not None:
+        conditions.append('Timestamp >= ?')
+        args.append(to_timestamp(start))
+    if end is not None:
+        conditions.append('Timestamp < ?')
+        args.append(to_timestamp(end))
+    if not len(conditions):
+        return '', args
+    return ' where ' + ' and '.join(conditions), args
+
+
+def iter_chunks(fn, chunk_size=100000):
+    # arrays of at most chunk_size rows from a database file or archive
+    path = archive.find(fn)
+    if path is not None:
+        arr = archive.load(path)
+        for i in range(0, len(arr), chunk_size):
+            yield arr[i:i + chunk_size]
+        return
+    with reader(fn) as db:
+        cur = db.cursor()
+        cur.execute('select %s from weather' % logger.select_columns(db))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not len(rows):
+                break
+            yield numpy.array(rows, dtype=logger.row_dtype)
+
+
+def load_range(
+        data_dir, start=None, end=None, columns=None, chunk_size=4096,
+        pool=None, cache=None):
+    # load rows with start <= Timestamp < end from all files in data_dir
+    # cache is an optional cache.ResultCache
+    dtype = get_dtype(columns)
+    names = [n for n, _ in dtype]
+    where, args = time_filter(start, end)
+
+    # count rows to preallocate the result, archives are loaded as is
+    # each database is opened while counting and again while filling so
+    # at most one file is open at a time
+    sources = []
+    total = 0
+    fns = find_files(data_dir, start, end)
+    for (i, fn) in enumerate(fns):
+        if cache is not None:
+            # only the first and last files are cut by the range, so
+            # others are cached whole and shared between ranges
+            a = cache.load(
+                fn, start if i == 0 else None,
+                end if i == len(fns) - 1 else None, names, pool)
+            total += len(a)
+            sources.append((a, len(a)))
+            continue
+        path = archive.find(fn)
+        if path is not None:
+            a = archive.load(path, start, end, names)
+            total += len(a)
+            sources.append((a, len(a)))
+            continue
+        with reader(fn, pool) as db:
+            cur = db.cursor()
+            cur.execute('select count(*) from weather' + where, args)
+            n = cur.fetchone()[0]
+            cur.close()
+        total += n
+        sources.append((fn, n))
+
+    arr = numpy.empty(total, dtype=dtype)
+    i = 0
+    for (src, n) in sources:
+        if isinstance(src, numpy.ndarray):
+            arr[i:i + n] = src
+            i += n
+            continue
+        with reader(src, pool) as db:
+            cur = db.cursor()
+            # rows written after counting are not included
+            cur.execute(
+                'select %s from weather%s order by Timestamp limit ?' % (
+                    logger.select_columns(db, names), where), args + [n, ])
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not len(rows):
+                    break
+                arr[i:i + len(rows)] = rows
+                i += len(rows)
+            cur.close()
+    return arr[:i]
@@ -0,0 +1,119 @@
+import os
+
+import numpy
+
+from . import binlog
+
+
+magic = b'PMCLRING'
+header_dtype = numpy.dtype([
+    ('magic', 'S8'), ('capacity', '<u8'), ('seq', '<u8'), ('count', '<u8')])
+
+
+class RingBufferError(Exception):
+    pass
+
+
+class RingBuffer:
+    # fixed size buffer of the most recent readings, optionally backed by
+    # a memory mapped file so other processes can read it
+    #
+    # the writer increments seq before (to odd) and after (to even) each
+    # append so readers can retry reads that overlap a write (seqlock)
+    def __init__(self, size=None, fn=None, writable=True):
+        self.fn = fn
+        self.record_dtype = binlog.get_record_dtype()
+        if fn is None:
+            if size is None:
+                raise RingBufferError("size is required without a file")
+            self.buffer = numpy.zeros(self.nbytes(size), dtype='u1')
+            self.init(size)
+            return
+        if writable:
+            self.open_writer(fn, size)
+        else:
+            self.open_reader(fn)
+
+    def nbytes(self, size):
+        return header_dtype.itemsize + size * self.record_dtype.itemsize
+
+    def map(self):
+        self.header = self.buffer[:header_dtype.itemsize].view(header_dtype)
+        capacity = int(self.header['capacity'][0])
+        self.records = self.buffer[
+            header_dtype.itemsize:self.nbytes(capacity)].view(
+                self.record_dtype)
+
+    def init(self, size):
+        self.buffer[:header_dtype.itemsize] = 0
+        h = self.buffer[:header_dtype.itemsize].view(header_dtype)
+        h['magic'] = magic
+        h['capacity'] = size
+        self.map()
+
+    def open_writer(self, fn, size):
+        # reuse an existing file of the same size to keep its readings
+        if os.path.exists(fn) and os.path.getsize(fn) == self.nbytes(size):
+            self.buffer = numpy.memmap(fn, dtype='u1', mode='r+')
+            h = self.buffer[:header_dtype.itemsize].view(header_dtype)
+            if h['magic'][0] == magic and h['capacity'][0] == size:
+                h['seq'] = h['seq'][0] + (h['seq'][0] % 2)
+                self.map()
+                return
+        self.buffer = numpy.memmap(
+            fn, dtype='u1', mode='w+', shape=(self.nbytes(size), ))
+        self.init(size)
+
+    def open_reader(self, fn):
+        self.buffer = numpy.memmap(fn, dtype='u1', mode='r')
+        h = self.buffer[:header_dtype.itemsize].view(header_dtype)
+        if h['magic'][0] != magic:
+            raise RingBufferError("Invalid magic %s" % h['magic'][0])
+        self.map()
+
+    @property
+    def capacity(self):
+        return len(self.records)
+
+    @property
+    def count(self):
+        # total number of readings ever appended
+        return int(self.header['count'][0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, row):
+        h = self.header
+        seq = int(h['seq'][0])
+        h['seq'] = seq + 1
+        count = int(h['count'][0])
+        self.records[count % self.capacity] = tuple(row)
+        h['count'] = count + 1
+        h['seq'] = seq + 2
+
+    def get(self, n=None, retries=100):
+        # copy of the last n readings (oldest first)
+        for _ in range(retries):
+            seq = int(self.header['seq'][0])
+            if seq % 2:
+                continue
+            count = int(self.header['count'][0])
+            k = min(count, self.capacity)
+            if n is not None:
+                k = min(k, max(n, 0))
+            indices = numpy.arange(count - k, count) % self.capacity
+            rs = self.records[indices]
+            if int(self.header['seq'][0]) == seq:
+                return rs
+        raise RingBufferError("Failed to read ring buffer")
+
+    def latest(self):
+        rs = self.get(1)
+        if not len(rs):
+            return None
+        return rs[0]
+
+    def flush(self):
+        if isinstance(self.buffer, numpy.memmap):
+            self.buffer.flush()
@@ -0,0 +1,324 @@
+import argparse
+import contextlib
+import math
+import os
+import sqlite3
+
+import numpy
+
+from . import config
+from . import logger
+from . import query
+
+
+# bucket sizes in seconds, buckets are aligned to the epoch (UTC days)
+resolutions = (60, 3600, 86400)
+fields = [n for n, _ in logger.line_tokens if n not in ('Time', 'SampleIndex')]
+agg_columns = ['Start', 'Station', 'Count']
+for f in fields:
+    agg_columns += ['%s_min' % f, '%s_max' % f, '%s_sum' % f]
+# WindDir is averaged as a unit vector
+agg_columns += ['WindDir_x', 'WindDir_y']
+agg_dtype = [
+    (c, int if c in ('Start', 'Station', 'Count') else float)
+    for c in agg_columns]
+row_index = dict([(n, i) for (i, (n, _)) in enumerate(logger.row_dtype)])
+# buckets of each file merged by replace_file (see backfill)
+parts_table = 'rollup_parts'
+
+
+def table_name(resolution):
+    return 'rollup_%i' % resolution
+
+
+def get_path(data_dir):
+    ddir = os.path.expanduser(data_dir)
+    if ddir == ':memory:':
+        return ddir
+    return os.path.join(ddir, 'rollup.sqlite')
+
+
+def create_tables(db):
+    cols = ', '.join([
+        '%s %s' % (n, 'integer' if t == int else 'float')
+        for (n, t) in agg_dtype])
+    with db:
+        for res in resolutions:
+            db.execute(
+                "create table if not exists %s(%s, primary key (Start, Station))"
+                % (table_name(res), cols))
+        db.execute(
+            "create table if not exists %s(File text, Resolution integer, "
+            "%s, primary key (File, Resolution, Start, Station))" % (
+                parts_table, cols))
+        db.execute(
+            "create index if not exists %s_bucket on %s"
+            "(Resolution, Start, Station)" % (parts_table, parts_table))
+
+
+def clear_tables(db):
+    with db:
+        for res in resolutions:
+            db.execute("delete from %s" % table_name(res))
+        db.execute("delete from %s" % parts_table)
+
+
+def upsert_sql(table, columns, keys):
+    # insert a bucket or merge it with an existing one
+    updates = []
+    for c in columns:
+        if c in keys:
+            continue
+        if c.endswith('_min'):
+            updates.append('%s = min(%s, excluded.%s)' % (c, c, c))
+        elif c.endswith('_max'):
+            updates.append('%s = max(%s, excluded.%s)' % (c, c, c))
+        else:
+            updates.append('%s = %s + excluded.%s' % (c, c, c))
+    return (
+        "insert into %s values (%s) "
+        "on conflict(%s) do update set %s" % (
+            table, ', '.join(['?', ] * len(columns)), ', '.join(keys),
+            ', '.join(updates)))
+
+
+def merge_sql(resolution):
+    return upsert_sql(
+        table_name(resolution), agg_columns, ('Start', 'Station'))
+
+
+def rebuild_sql(resolution):
+    # one rollup bucket from the parts of all files
+    aggs = []
+    for c in agg_columns[2:]:
+        if c.endswith('_min'):
+            aggs.append('min(%s)' % c)
+        elif c.endswith('_max'):
+            aggs.append('max(%s)' % c)
+        else:
+            aggs.append('sum(%s)' % c)
+    return (
+        "insert into %s select Start, Station, %s from %s "
+        "where Resolution = ? and Start = ? and Station = ? "
+        "group by Start, Station" % (
+            table_name(resolution), ', '.join(aggs), parts_table))
+
+
+def write(db, records, resolutions=resolutions):
+    # merge buckets (sequences in agg_columns order) into the rollup
+    # tables, bucket starts are aligned to each resolution
+    if not len(records):
+        return
+    with db:
+        for res in resolutions:
+            db.executemany(merge_sql(res), [
+                [r[0] - r[0] % res, ] + list(r[1:]) for r in records])
+
+
+def replace_file(db, fn, buckets):
+    # merge the buckets (per resolution) of one file, replacing any the
+    # file had before, affected rollup buckets are rebuilt from the parts
+    # of all files so redoing a file never counts it twice
+    name = os.path.basename(fn)
+    columns = ['File', 'Resolution'] + agg_columns
+    upsert = upsert_sql(
+        parts_table, columns, ('File', 'Resolution', 'Start', 'Station'))
+    with db:
+        for res in resolutions:
+            keys = set(db.execute(
+                "select Start, Station from %s "
+                "where File = ? and Resolution = ?" % parts_table,
+                (name, res)).fetchall())
+            db.execute(
+                "delete from %s where File = ? and Resolution = ?" %
+                parts_table, (name, res))
+            records = [
+                [name, res, r[0] - r[0] % res] + list(r[1:])
+                for r in buckets.get(res, [])]
+            db.executemany(upsert, records)
+            keys.update([(r[2], r[3]) for r in records])
+            keys = sorted(keys)
+            db.executemany(
+                "delete from %s where Start = ? and Station = ?" %
+                table_name(res), keys)
+            db.executemany(rebuild_sql(res), [(res, ) + k for k in keys])
+
+
+def new_bucket(start, station):
+    b = [start, station, 0]
+    for f in fields:
+        b += [math.inf, -math.inf, 0.]
+    return b + [0., 0.]
+
+
+def accumulate(bucket, row):
+    bucket[2] += 1
+    for (i, f) in enumerate(fields):
+        v = row[row_index[f]]
+        j = 3 + i * 3
+        if v < bucket[j]:
+            bucket[j] = v
+        if v > bucket[j + 1]:
+            bucket[j + 1] = v
+        bucket[j + 2] += v
+    a = math.radians(row[row_index['WindDir']])
+    bucket[-2] += math.cos(a)
+    bucket[-1] += math.sin(a)
+
+
+def aggregate(arr, resolution):
+    # vectorized bucketing of an array of row_dtype
+    out = numpy.empty(0, dtype=agg_dtype)
+    if not len(arr):
+        return out
+    starts = arr['Timestamp'] - arr['Timestamp'] % resolution
+    order = numpy.lexsort((starts, arr['Station']))
+    arr = arr[order]
+    starts = starts[order]
+    stations = arr['Station']
+    edges = numpy.flatnonzero(
+        (numpy.diff(starts) != 0) | (numpy.diff(stations) != 0)) + 1
+    idx = numpy.concatenate(([0, ], edges))
+    out = numpy.empty(len(idx), dtype=agg_dtype)
+    out['Start'] = starts[idx]
+    out['Station'] = stations[idx]
+    out['Count'] = numpy.diff(numpy.append(idx, len(arr)))
+    for f in fields:
+        out['%s_min' % f] = numpy.minimum.reduceat(arr[f], idx)
+        out['%s_max' % f] = numpy.maximum.reduceat(arr[f], idx)
+        out['%s_sum' % f] = numpy.add.reduceat(arr[f], idx)
+    a = numpy.radians(arr['WindDir'])
+    out['WindDir_x'] = numpy.add.reduceat(numpy.cos(a), idx)
+    out['WindDir_y'] = numpy.add.reduceat(numpy.sin(a), idx)
+    return out
+
+
+class Rollups:
+    # accumulate readings into the finest bucket per station and merge
+    # completed buckets into all rollup tables
+    def __init__(self, db):
+        self.db = db
+        create_tables(db)
+        self.buckets = {}
+        self.pending = []
+
+    def add(self, row):
+        ts = row[0]
+        station = row[-1]
+        start = ts - ts % resolutions[0]
+        bucket = self.buckets.get(station)
+        if bucket is None or bucket[0] != start:
+            if bucket is not None:
+                self.pending.append(bucket)
+            bucket = new_bucket(start, station)
+            self.buckets[station] = bucket
+        accumulate(bucket, row)
+        if len(self.pending):
+            self.flush()
+
+    def flush(self, partial=False):
+        # partial buckets can be written as later rows are merged
+        if partial:
+            for (station, bucket) in self.buckets.items():
+                if bucket[2]:
+                    self.pending.append(bucket)
+            self.buckets = {}
+        write(self.db, self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush(partial=True)
+        self.db.close()
+
+
+def choose_resolution(start, end, max_points=1000):
+    # finest resolution that returns at most max_points buckets
+    span = query.to_timestamp(end) - query.to_timestamp(start)
+    for res in resolutions:
+        if span / res <= max_points:
+            return res
+    return resolutions[-1]
+
+
+def load(
+        data_dir, start, end, max_points=1000, columns=None, station=None,
+        resolution=None):
+    if columns is None:
+        columns = fields
+    for c in columns:
+        if c not in fields:
+            raise ValueError("Unknown column %s" % c)
+    if resolution is None:
+        resolution = choose_resolution(start, end, max_points)
+    start = query.to_timestamp(start)
+    start -= start % resolution
+    end = query.to_timestamp(end)
+
+    names = ['Start', 'Station', 'Count']
+    for c in columns:
+        names += ['%s_min' % c, '%s_max' % c, '%s_sum' % c]
+    if 'WindDir' in columns:
+        names += ['WindDir_x', 'WindDir_y']
+    sql = 'select %s from %s where Start >= ? and Start < ?' % (
+        ', '.join(names), table_name(resolution))
+    args = [start, end]
+    if station is not None:
+        sql += ' and Station = ?'
+        args.append(station)
+    with contextlib.closing(query.connect(get_path(data_dir))) as db:
+        cur = db.cursor()
+        cur.execute(sql + ' order by Start', args)
+        rs = numpy.array(cur.fetchall(), dtype=[
+            (n, dict(agg_dtype)[n]) for n in names])
+
+    dtype = [('Timestamp', int), ('Station', int), ('Count', int)]
+    for c in columns:
+        dtype += [('%s_mean' % c, float), ('%s_min' % c, float),
+                  ('%s_max' % c, float)]
+    if 'Rain' in columns:
+        dtype.append(('Rain_sum', float))
+    arr = numpy.empty(len(rs), dtype=dtype)
+    arr['Timestamp'] = rs['Start']
+    arr['Station'] = rs['Station']
+    arr['Count'] = rs['Count']
+    for c in columns:
+        arr['%s_mean' % c] = rs['%s_sum' % c] / rs['Count']
+        arr['%s_min' % c] = rs['%s_min' % c]
+        arr['%s_max' % c] = rs['%s_max' % c]
+    if 'Rain' in columns:
+        arr['Rain_sum'] = rs['Rain_sum']
+    if 'WindDir' in columns:
+        arr['WindDir_mean'] = numpy.degrees(
+            numpy.arctan2(rs['WindDir_y'], rs['WindDir_x'])) % 360
+    return arr
+
+
+def backfill(data_dir, rebuild=True):
+    # build rollups for all database files in data_dir
+    db = sqlite3.connect(get_path(data_dir))
+    create_tables(db)
+    if rebuild:
+        clear_tables(db)
+    fns = query.find_files(data_dir)
+    for fn in fns:
+        arr = logger.load_file(fn)
+        for res in resolutions:
+            write(db, aggregate(arr, res).tolist(), [res, ])
+        print("Rolled up %s[%s rows]" % (fn, len(arr)))
+    db.close()
+    return fns
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Data directory to roll up")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    backfill(cfg['data_dir'])
@@ -0,0 +1,192 @@
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy
+
+from . import binlog
+from . import derived
+from . import logger
+
+
+def configure(db, cfg):
+    # journaling and cache settings for a writer connection, with wal
+    # readers and the writer do not block each other
+    db.execute('pragma journal_mode = %s' % cfg.get('journal_mode', 'wal'))
+    db.execute('pragma synchronous = %s' % cfg.get('synchronous', 'normal'))
+    db.execute('pragma cache_size = %i' % -cfg.get('sqlite_cache_kb', 8192))
+    db.execute('pragma mmap_size = %i' % cfg.get('mmap_size', 0))
+    if cfg.get('checkpoint_interval', 0) > 0:
+        # checkpoints are run by a Checkpointer instead of on commit
+        db.execute('pragma wal_autocheckpoint = 0')
+
+
+class Checkpointer:
+    # periodically copy the wal back into the database from a thread
+    # with its own connection, passive checkpoints never block the
+    # writer or readers
+    def __init__(self, fn, interval):
+        self.fn = fn
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.n_checkpoints = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def checkpoint(self):
+        db = sqlite3.connect(self.fn)
+        try:
+            db.execute('pragma wal_checkpoint(passive)')
+        finally:
+            db.close()
+        self.n_checkpoints += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.checkpoint()
+            except sqlite3.Error as e:
+                logging.error("Failed to checkpoint %s: %s", self.fn, e)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class SQLiteStorage:
+    extension = '.sqlite'
+
+    def __init__(self, fn, cfg):
+        self.fn = fn
+        # allow the connection to be used by a pipeline writer thread
+        self.db = sqlite3.connect(fn, check_same_thread=False)
+        self.checkpointer = None
+        if fn != ':memory:':
+            configure(self.db, cfg)
+            wal = self.db.execute('pragma journal_mode').fetchone()[0]
+            if wal == 'wal' and cfg.get('checkpoint_interval', 0) > 0:
+                self.checkpointer = Checkpointer(
+                    fn, cfg['checkpoint_interval'])
+        logger.create_table(self.db, cfg.get('clustered', False))
+        if cfg.get('derived', False):
+            derived.create_table(self.db)
+        # reuse one cursor and the same statement text per table so
+        # sqlite's statement cache skips re-preparing inserts
+        self.cursor = self.db.cursor()
+        self.statements = {}
+
+    def statement(self, table, n):
+        key = (table, n)
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = "insert or replace into %s values (%s)" % (
+                table, ', '.join(['?', ] * n))
+            self.statements[key] = sql
+        return sql
+
+    def write(self, rows, table='weather'):
+        if not len(rows):
+            return
+        with self.db:
+            self.cursor.executemany(self.statement(table, len(rows[0])), rows)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+        # an open cursor keeps the connection (and its wal) alive
+        self.cursor.close()
+        if self.fn != ':memory:':
+            # leaving wal mode copies the wal into the database so closed
+            # files are self contained and readers create no wal or shm,
+            # the wal mode is set again if the file is reopened
+            try:
+                self.db.execute('pragma journal_mode = delete')
+            except sqlite3.Error as e:
+                logging.error("Failed to checkpoint %s: %s", self.fn, e)
+        self.db.close()
+
+
+class BinaryStorage:
+    # append only binary log (see binlog) of row_dtype records
+    # written rows are flushed to the os and fsync'd every fsync_interval
+    extension = '.bin'
+
+    def __init__(self, fn, cfg):
+        self.fn = fn
+        self.db = None
+        self.fsync_interval = cfg.get('fsync_interval', 1.)
+        self.last_sync = time.monotonic()
+        self.record_dtype = binlog.get_record_dtype()
+        if fn == ':memory:':
+            self.f = io.BytesIO()
+        elif os.path.exists(fn):
+            self.f = open(fn, 'r+b')
+        else:
+            self.f = open(fn, 'w+b')
+        self.recover()
+
+    def recover(self):
+        # validate the header and drop any partially written record
+        self.f.seek(0, os.SEEK_END)
+        size = self.f.tell()
+        if size < binlog.header_dtype.itemsize:
+            self.f.seek(0)
+            self.f.truncate()
+            self.f.write(binlog.make_header())
+            self.f.flush()
+            return
+        self.f.seek(0)
+        binlog.read_header(self.f)
+        n = (size - binlog.header_dtype.itemsize) // self.record_dtype.itemsize
+        end = binlog.header_dtype.itemsize + n * self.record_dtype.itemsize
+        if end != size:
+            self.f.truncate(end)
+        self.f.seek(end)
+
+    def write(self, rows, table='weather'):
+        if table != 'weather':
+            raise ValueError("Binary storage only stores weather rows")
+        rs = numpy.array([tuple(r) for r in rows], dtype=self.record_dtype)
+        self.f.write(rs.tobytes())
+        self.f.flush()
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self.last_sync = time.monotonic()
+        if hasattr(self.f, 'fileno'):
+            try:
+                os.fsync(self.f.fileno())
+            except io.UnsupportedOperation:
+                pass
+
+    def flush(self):
+        self.f.flush()
+        self.sync()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+backends = {
+    'sqlite': SQLiteStorage,
+    'binary': BinaryStorage,
+}
+
+
+def open_storage(name, fn, cfg):
+    # fn is the database filename without extension (or ':memory:')
+    if name not in backends:
+        raise ValueError("Unknown storage backend %s" % name)
+    backend = backends[name]
+    if fn != ':memory:':
+        fn += backend.extension
+    return backend(fn, cfg)
@@ -0,0 +1,137 @@
+import http.server
+import json
+import queue
+import threading
+import urllib.parse
+
+from . import logger
+
+
+class Subscriber:
+    # bounded queue of readings, when full the oldest reading is dropped
+    # so a slow consumer never blocks the publisher
+    def __init__(self, fields=None, decimate=1, queue_size=256):
+        self.fields = fields
+        self.decimate = max(1, decimate)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.n_offered = 0
+        self.n_dropped = 0
+
+    def offer(self, reading):
+        self.n_offered += 1
+        if (self.n_offered - 1) % self.decimate:
+            return
+        if self.fields is not None:
+            reading = dict([(k, reading[k]) for k in self.fields])
+        while True:
+            try:
+                self.queue.put_nowait(reading)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                self.n_dropped += 1
+            except queue.Empty:
+                pass
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Publisher:
+    def __init__(self, queue_size=256):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def subscribe(self, fields=None, decimate=1):
+        names = [n for n, _ in logger.row_dtype]
+        if fields is not None:
+            for f in fields:
+                if f not in names:
+                    raise ValueError("Unknown field %s" % f)
+        s = Subscriber(fields, decimate, self.queue_size)
+        with self.lock:
+            self.subscribers.add(s)
+        return s
+
+    def unsubscribe(self, s):
+        with self.lock:
+            self.subscribers.discard(s)
+
+    def publish(self, row):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        if not len(subscribers):
+            return
+        reading = dict(zip([n for n, _ in logger.row_dtype], row))
+        for s in subscribers:
+            s.offer(reading)
+
+    def serve(self, host='127.0.0.1', port=8090):
+        # serve server-sent events at /stream?fields=a,b&decimate=n
+        handler = type('Handler', (StreamHandler, ), {'publisher': self})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.server.server_address
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    publisher = None
+    keepalive = 15.
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/stream':
+            self.send_error(404)
+            return
+        args = urllib.parse.parse_qs(url.query)
+        fields = None
+        if 'fields' in args:
+            fields = args['fields'][0].split(',')
+        try:
+            decimate = int(args.get('decimate', ['1', ])[0])
+            s = self.publisher.subscribe(fields, decimate)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while self.publisher.server is not None:
+                reading = s.get(timeout=self.keepalive)
+                if reading is None:
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    # nan is not valid json
+                    reading = dict([
+                        (k, None if v != v else v)
+                        for (k, v) in reading.items()])
+                    self.wfile.write(
+                        b'data: ' + json.dumps(reading).encode('ascii') +
+                        b'\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.publisher.unsubscribe(s)
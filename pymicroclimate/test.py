@@ -1,24 +1,95 @@
 import datetime
+import fcntl
+import http.client
+import io
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import struct
+import tempfile
+import termios
+import threading
+import time
 
+import numpy
 import serial
 
+from . import analysis
+from . import archive
+from . import backfill
+from . import bench
+from . import cache
+from . import capture
+from . import binlog
 from . import config
+from . import derived
+from . import ingest
 from . import logger
+from . import metrics
+from . import pipeline
+from . import protocol
+from . import query
+from . import ring
+from . import rollup
+from . import storage
+from . import stream
+from . import ui
 
 
 class MockSerial:
     def __init__(self, *args, **kwargs):
         self.line = None
-        pass
+        self.lines = []
+
+    @property
+    def in_waiting(self):
+        return sum([len(l) for l in self.lines])
+
+    def read(self, n=1):
+        data = b''.join(self.lines)
+        self.lines = []
+        if len(data) > n:
+            self.lines = [data[n:], ]
+        return data[:n]
 
     def readline(self):
+        if self.line is None and len(self.lines):
+            self.line = self.lines.pop(0)
         l = self.line
         if l is None:
+            # avoid spinning when polled from a thread
+            time.sleep(0.001)
             l = b"\n"
         self.line = None
         return l
 
 
+class PipeSerial:
+    # serial port backed by a pipe, so it can be used with selectors
+    def __init__(self):
+        self.r, self.w = os.pipe()
+
+    def fileno(self):
+        return self.r
+
+    @property
+    def in_waiting(self):
+        return struct.unpack(
+            'i', fcntl.ioctl(self.r, termios.FIONREAD, b'\0' * 4))[0]
+
+    def read(self, n=1):
+        return os.read(self.r, n)
+
+    def write(self, data):
+        os.write(self.w, data)
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
 def build_line(**kwargs):
     s = ''
     for (k, t) in logger.line_tokens:
@@ -64,6 +135,15 @@ def test_reading():
                 assert r.data[dk] == v
             else:
                 assert r.data[dk] == 0
+    row = logger.parse_row(build_line(WBTemp=1.5), ts, 2)
+    assert isinstance(row, tuple)
+    r.from_line(build_line(WBTemp=1.5), ts, 2)
+    assert list(row) == r.to_row()
+    try:
+        logger.parse_row('1,2', ts)
+        assert False
+    except logger.ReadingError:
+        assert True
 
 
 def test_logger():
@@ -105,6 +185,7 @@ def test_logger():
     ts3 = ts + datetime.timedelta(days=1)
     l.parse_line(line, ts3)
     assert len(get_all(l.db)) == 1
+    l.close()
 
     # test parsing from fake serial input
     l = logger.Logger({
@@ -114,10 +195,1332 @@ def test_logger():
     l.conn.line = line.encode('ascii')
     l.read_serial_line()
     assert len(get_all(l.db)) == 1
+    l.close()
+
+    # split by hour, the next file is opened before the hour ends
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'split_by': 'hour',
+            'prepare_interval': 60,
+        })
+        l.parse_line(line, datetime.datetime(2020, 1, 1, 10, 30))
+        assert l.split_end == datetime.datetime(2020, 1, 1, 11)
+        l.parse_line(line, datetime.datetime(2020, 1, 1, 10, 59, 30))
+        assert l.next is not None
+        l.parse_line(line, datetime.datetime(2020, 1, 1, 11, 0, 10))
+        assert l.next is None
+        l.flush()
+        fns = query.find_files(ddir)
+        assert [os.path.basename(fn) for fn in fns] == [
+            '200101_10.sqlite', '200101_11.sqlite']
+        assert [len(logger.load_file(fn)) for fn in fns] == [2, 1]
+
+        # unused prepared files are removed
+        l.parse_line(line, datetime.datetime(2020, 1, 1, 11, 59, 59))
+        assert l.next is not None
+        l.close()
+        assert len(query.find_files(ddir)) == 2
+    finally:
+        shutil.rmtree(ddir)
+    # timezone aware timestamps
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir})
+        tz = datetime.timezone(datetime.timedelta(hours=2))
+        t = datetime.datetime(2020, 1, 1, 12, tzinfo=tz)
+        l.parse_line(line, t)
+        l.parse_line(line, t + datetime.timedelta(hours=11, seconds=3595))
+        assert l.next is not None
+        l.parse_line(line, t + datetime.timedelta(days=1))
+        l.close()
+        assert [len(logger.load_file(fn))
+                for fn in query.find_files(ddir)] == [2, 1]
+    finally:
+        shutil.rmtree(ddir)
+    # weeks start on monday
+    assert query.period_start(
+        datetime.datetime(2020, 1, 1, 5), 'week') == datetime.datetime(
+            2019, 12, 30)
+
+
+def test_batch_writer():
+    serial.Serial = MockSerial
+    l = logger.Logger({
+        'data_dir': ':memory:',
+        'split_days': True,
+        'batch_size': 3,
+    })
+
+    line = build_line(Rain=1.5)
+    ts = datetime.datetime.fromtimestamp(5E8)
+
+    # rows are held until the batch is full
+    l.parse_line(line, ts)
+    l.parse_line(line, ts)
+    assert len(get_all(l.db)) == 0
+    l.parse_line(line, ts)
+    assert len(get_all(l.db)) == 3
+    l.close()
+
+    # split flushes and closes the previous file in the background
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir, 'batch_size': 3})
+        l.parse_line(line, ts)
+        fn = l.db_fn
+        l.parse_line(line, ts + datetime.timedelta(days=1))
+        assert len(get_all(l.db)) == 0
+        l.wait()
+        assert len(logger.load_file(fn)) == 1
+
+        # flush writes a partial batch
+        l.flush()
+        assert len(get_all(l.db)) == 1
+        l.close()
+    finally:
+        shutil.rmtree(ddir)
+
+    # batch interval
+    l = logger.Logger({
+        'data_dir': ':memory:',
+        'batch_size': 100,
+        'batch_interval': 0.01,
+    })
+    l.parse_line(line, ts)
+    assert len(get_all(l.db)) == 0
+    l.writer.last_flush -= 1.
+    l.parse_line(line, ts)
+    assert len(get_all(l.db)) == 2
+    l.close()
+
+
+def test_pipeline():
+    serial.Serial = MockSerial
+    l = logger.Logger({
+        'data_dir': ':memory:',
+        'batch_size': 2,
+    })
+    line = build_line(Rain=1.5).encode('ascii')
+    l.conn.lines = [line, ] * 5 + [b"#comment\n", b"0,1\n"]
+    p = pipeline.Pipeline(l, queue_size=4)
+    p.start()
+    t0 = time.monotonic()
+    while p.n_read < 7 and time.monotonic() - t0 < 5.:
+        time.sleep(0.01)
+    p.stop()
+    assert p.n_read == 7
+    assert p.n_invalid == 1
+    assert p.depth == 0
+    # stopping flushes any partial batch
+    assert len(get_all(l.db)) == 5
+
+    # full queues count backpressure and then drop lines
+    p = pipeline.Pipeline(l, queue_size=1, put_timeout=0.01)
+    assert p.enqueue(line, datetime.datetime.now())
+    assert not p.enqueue(line, datetime.datetime.now())
+    stats = p.stats()
+    assert stats['depth'] == 1
+    assert stats['backpressured'] == 1
+    assert stats['dropped'] == 1
+    assert p.process()
+    assert p.n_written == 1
+    assert len(l.writer.rows) == 1
+    l.close()
+
+    # buffered rows are written when the run loop fails
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir, 'batch_size': 10})
+        l.conn.lines = [line, ]
+
+        def fail():
+            raise RuntimeError("failed")
+
+        l.report_metrics = fail
+        try:
+            pipeline.run(l, l.cfg)
+            assert False
+        except RuntimeError:
+            assert True
+        assert sum([len(logger.load_file(fn))
+                    for fn in query.find_files(ddir)]) == 1
+    finally:
+        shutil.rmtree(ddir)
+
+    # storage errors in the writer thread stop the run loop
+    ddir = tempfile.mkdtemp()
+    write = storage.SQLiteStorage.write
+    try:
+        def fail_write(self, rows, table='weather'):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        storage.SQLiteStorage.write = fail_write
+        l = logger.Logger({'data_dir': ddir})
+        l.conn.lines = [line, ]
+        try:
+            pipeline.run(l, l.cfg)
+            assert False
+        except sqlite3.OperationalError:
+            assert True
+    finally:
+        storage.SQLiteStorage.write = write
+        shutil.rmtree(ddir)
+
+
+def test_multi_station():
+    serial.Serial = MockSerial
+    cfg = {
+        'data_dir': ':memory:',
+        'ports': ['/dev/ttyACM0', '/dev/ttyACM1'],
+    }
+    config.load_config(cfg)
+    try:
+        config.verify_config({'data_dir': '', 'port': '', 'ports': [0, ]})
+        assert False
+    except config.ConfigError:
+        assert True
+    assert config.get_ports({'port': 'a', 'ports': []}) == ['a', ]
+    l = logger.Logger(cfg)
+    assert len(l.conns) == 2
+
+    line = build_line(Rain=1.5)
+    ts = datetime.datetime.fromtimestamp(5E8)
+    l.parse_line(line, ts)
+    l.parse_line(line, ts, station=1)
+    rows = get_all(l.db)
+    assert [r[-1] for r in rows] == [0, 1]
+
+    # lines split across reads are reassembled per station
+    r = logger.PortReader(l.conns[1], 1)
+    data = (line + '\n' + line + '\n').encode('ascii')
+    assert r.feed(data[:5]) == []
+    assert len(r.feed(data[5:])) == 2
+    assert r.buffer == b''
+    l.conns[1].lines = [data, ]
+    lines = []
+    while l.conns[1].in_waiting:
+        lines += r.read()
+    assert len(lines) == 2
+
+    # pipeline readers tag lines with their station
+    l.conns[1].lines = [line.encode('ascii'), ]
+    p = pipeline.Pipeline(l)
+    p.start()
+    t0 = time.monotonic()
+    while p.n_read < 1 and time.monotonic() - t0 < 5.:
+        time.sleep(0.01)
+    p.stop()
+    # pipeline lines are timestamped now so are in a new day
+    rows = get_all(l.db)
+    assert [r[-1] for r in rows] == [1, ]
+    l.close()
+
+    # ports can set stable station ids
+    ids_cfg = {
+        'data_dir': ':memory:',
+        'ports': ['/dev/serial/by-id/usb-a=7', '/dev/ttyACM1'],
+    }
+    assert config.get_ports(ids_cfg) == [
+        '/dev/serial/by-id/usb-a', '/dev/ttyACM1']
+    assert config.get_stations(ids_cfg) == [7, 1]
+    for ports in (['a=1', 'b'], ['a=x']):
+        try:
+            config.verify_config({'data_dir': '', 'port': '', 'ports': ports})
+            assert False
+        except config.ConfigError:
+            assert True
+    l = logger.Logger(ids_cfg)
+    l.conns[0].lines = [line.encode('ascii'), ]
+    p = pipeline.Pipeline(l)
+    p.start()
+    t0 = time.monotonic()
+    while p.n_read < 1 and time.monotonic() - t0 < 5.:
+        time.sleep(0.01)
+    p.stop()
+    assert [r[-1] for r in get_all(l.db)] == [7, ]
+    l.close()
+
+    # the selector loop skips garbage and invalid lines on any port
+    conns = [PipeSerial(), PipeSerial()]
+    l = logger.Logger(dict(cfg, metrics=True), conns)
+    good = (line + '\n').encode('ascii')
+    conns[0].write(b'\xff\xfe' + good[:10])
+    conns[1].write(good + b'1,x' + good[3:])
+    conns[0].write(good[10:] + good)
+    t0 = time.monotonic()
+    while l.metrics.lines_parsed.value < 2 and time.monotonic() - t0 < 5.:
+        l.read_serial_ports(0.01)
+    assert l.metrics.lines_rejected.value == 2
+    l.flush()
+    assert sorted([r[-1] for r in get_all(l.db)]) == [0, 1]
+    l.close()
+    for c in conns:
+        c.close()
+
+
+def test_ingest():
+    ts = datetime.datetime.fromtimestamp(5E8)
+    line = build_line(Rain=1.5, SampleIndex=3)
+    lines = [
+        line,
+        '',
+        '#Time,Light',
+        ' ' + line + ' ',
+        '0,1',
+        line.replace('1.5', 'x'),
+        '1.5' + line[1:],
+        build_line(WBTemp=20.25, Time=7),
+    ]
+    arr, n_rejected = ingest.parse_lines('\n'.join(lines), ts, station=2)
+    assert n_rejected == 3
+    assert len(arr) == 3
+    r = logger.Reading()
+    r.from_line(lines[-1], ts, station=2)
+    assert tuple(arr[-1]) == tuple(r.to_row())
+    assert numpy.all(arr['Rain'][:2] == 1.5)
+
+    # per-line timestamps
+    arr, _ = ingest.parse_lines('\n'.join(lines), numpy.arange(len(lines)))
+    assert list(arr['Timestamp']) == [0, 3, 7]
+
+    # nothing to parse
+    arr, n_rejected = ingest.parse_lines(b'#\n\n')
+    assert len(arr) == 0 and n_rejected == 0
+
+    db = sqlite3.connect(':memory:')
+    logger.create_table(db)
+    ingest.insert_array(db, arr)
+    arr, _ = ingest.parse_lines('\n'.join(lines), ts)
+    ingest.insert_array(db, arr)
+    assert len(get_all(db)) == 3
+
+    # a leading bad line does not reject the lines after it
+    lines = [build_line(Time=i) for i in range(1000)]
+    lines[500] = lines[500].replace('0', '1.2.3', 1)
+    arr, n_rejected = ingest.parse_lines(
+        '\n'.join([line.replace('1.5', 'garbage'), ] + lines))
+    assert n_rejected == 2
+    assert len(arr) == 999
+    assert numpy.all(
+        arr['Time'] == numpy.delete(numpy.arange(1000), 500))
+
+
+def test_load_range():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'split_days': True,
+        })
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(3 * 24):
+            ts = t0 + datetime.timedelta(hours=i)
+            l.parse_line(build_line(Time=i, WBTemp=i * 0.5), ts)
+        l.close()
+        assert len(os.listdir(ddir)) == 3
+
+        arr = query.load_range(ddir)
+        assert len(arr) == 72
+        assert numpy.all(arr['Time'] == numpy.arange(72))
+
+        # range spanning a day boundary only needs 2 files
+        start = t0 + datetime.timedelta(hours=20)
+        end = t0 + datetime.timedelta(hours=30)
+        assert len(query.find_files(ddir, start, end)) == 2
+        arr = query.load_range(
+            ddir, start, end, columns=['Timestamp', 'WBTemp'])
+        assert arr.dtype.names == ('Timestamp', 'WBTemp')
+        assert len(arr) == 10
+        assert arr['WBTemp'][0] == 10.
+        assert arr['Timestamp'][0] == start.timestamp()
+
+        # open ended ranges
+        assert len(query.load_range(ddir, start=start)) == 52
+        assert len(query.load_range(ddir, end=datetime.date(2020, 1, 2))) == 24
+        assert len(query.load_range(ddir, chunk_size=5)) == 72
+
+        try:
+            query.load_range(ddir, columns=['Foo'])
+            assert False
+        except ValueError:
+            assert True
+    finally:
+        shutil.rmtree(ddir)
+
+    # files are opened one at a time, so ranges can span more files than
+    # the open file limit
+    ddir = tempfile.mkdtemp()
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        l = logger.Logger({'data_dir': ddir, 'split_by': 'hour'})
+        for i in range(120):
+            ts = t0 + datetime.timedelta(hours=i)
+            l.parse_line(build_line(Time=i), ts)
+        l.close()
+        n_open = len(os.listdir('/proc/self/fd'))
+        resource.setrlimit(
+            resource.RLIMIT_NOFILE, (n_open + 32, limits[1]))
+        arr = query.load_range(ddir)
+        assert len(arr) == 120
+        assert numpy.all(arr['Time'] == numpy.arange(120))
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        shutil.rmtree(ddir)
+
+
+def test_schema():
+    # files from before Station and the Timestamp index are upgraded
+    db = sqlite3.connect(':memory:')
+    db.execute(
+        "create table weather(%s)" %
+        ', '.join([n for n, _ in logger.row_dtype[:-1]]))
+    db.execute(
+        "insert into weather values (%s)" %
+        ', '.join(['1', ] * (len(logger.row_dtype) - 1)))
+    logger.create_table(db)
+    assert logger.table_columns(db)[-1] == 'Station'
+    assert get_all(db)[0][-1] == 0
+    plan = db.execute(
+        "explain query plan select * from weather where Timestamp > 0"
+    ).fetchall()
+    assert 'weather_Timestamp' in str(plan)
+    # upgrading again is a no-op
+    logger.create_table(db)
+
+    # clustered tables replace duplicate readings
+    db = sqlite3.connect(':memory:')
+    logger.create_table(db, clustered=True)
+    assert logger.is_clustered(db)
+    r = logger.Reading()
+    ts = datetime.datetime.fromtimestamp(5E8)
+    r.from_line(build_line(), ts)
+    r.to_db(db)
+    r.to_db(db)
+    assert len(get_all(db)) == 1
+    plan = db.execute(
+        "explain query plan select * from weather where Timestamp > 0"
+    ).fetchall()
+    assert 'PRIMARY KEY' in str(plan)
+
+    # load_file time ranges
+    fd, fn = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        db = sqlite3.connect(fn)
+        logger.create_table(db)
+        for i in range(10):
+            r.from_line(build_line(Time=i), ts + datetime.timedelta(seconds=i))
+            r.to_db(db)
+        db.close()
+        assert len(logger.load_file(fn)) == 10
+        arr = logger.load_file(
+            fn, start=ts + datetime.timedelta(seconds=2),
+            end=ts + datetime.timedelta(seconds=5), columns=['Time', ])
+        assert list(arr['Time']) == [2, 3, 4]
+    finally:
+        os.remove(fn)
+
+
+def test_rollup():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'rollups': True,
+        })
+        t0 = datetime.datetime(2020, 1, 1)
+        n = 2 * 360
+        for i in range(n):
+            ts = t0 + datetime.timedelta(seconds=i * 10)
+            l.parse_line(build_line(
+                WindDir=350 if i % 2 else 10, Rain=0.5, WBTemp=i), ts)
+        l.close()
+
+        start = t0
+        end = t0 + datetime.timedelta(hours=2)
+        assert rollup.choose_resolution(start, end, 1000) == 60
+        assert rollup.choose_resolution(start, end, 10) == 3600
+        assert rollup.choose_resolution(start, end, 1) == 86400
+        arr = rollup.load(ddir, start, end, max_points=10)
+        assert list(arr['Count']) == [360, 360]
+        assert numpy.all(arr['Rain_sum'] == 180)
+        assert numpy.all(arr['Rain_mean'] == 0.5)
+        assert list(arr['WBTemp_min']) == [0, 360]
+        assert list(arr['WBTemp_max']) == [359, 719]
+        wd = arr['WindDir_mean']
+        assert numpy.all(numpy.minimum(wd, 360 - wd) < 1e-6)
+        arr = rollup.load(ddir, start, end, columns=['WBTemp', ])
+        assert len(arr) == 120
+        assert 'Rain_sum' not in arr.dtype.names
+        assert numpy.all(arr['Count'] == 6)
+
+        # backfill from the day files gives the same rollups
+        incremental = rollup.load(ddir, start, end, resolution=60)
+        rollup.backfill(ddir)
+        backfilled = rollup.load(ddir, start, end, resolution=60)
+        for name in incremental.dtype.names:
+            assert numpy.allclose(incremental[name], backfilled[name])
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_archive():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'archive': 'npz',
+        })
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(3 * 24):
+            ts = t0 + datetime.timedelta(hours=i)
+            l.parse_line(build_line(Time=i, WBTemp=i * 0.5), ts)
+        l.close()
+        fns = query.find_files(ddir)
+        assert len(fns) == 3
+        # closed days are archived as they are split
+        assert archive.find(fns[0]).endswith('.npz')
+        assert archive.find(fns[1]).endswith('.npz')
+        assert archive.find(fns[2]) is None
+        expected = query.load_range(ddir)
+
+        # cols archives are memory mapped and the database removed
+        os.remove(archive.find(fns[0]))
+        archive.compact(fns[0], 'cols', remove=True)
+        assert not os.path.exists(fns[0])
+        assert archive.find(fns[0]).endswith('.cols')
+        assert isinstance(
+            archive.load_columns(archive.find(fns[0]))['Time'],
+            numpy.memmap)
+        assert query.find_files(ddir) == fns
+
+        arr = query.load_range(ddir)
+        assert numpy.all(arr == expected)
+        arr = logger.load_file(fns[0])
+        assert numpy.all(arr == expected[:24])
+        start = t0 + datetime.timedelta(hours=20)
+        end = t0 + datetime.timedelta(hours=30)
+        arr = query.load_range(ddir, start, end, columns=['Time', ])
+        assert list(arr['Time']) == list(range(20, 30))
+        arr = logger.load_file(fns[1], start=start, end=end)
+        assert list(arr['Time']) == list(range(24, 30))
+        assert len(logger.load_file(fns[1], as_array=False)) == 24
+
+        # the newest file is not archived
+        assert archive.compact_dir(ddir) == []
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_binlog():
+    ts = datetime.datetime.fromtimestamp(5E8)
+    lines = '\n'.join([build_line(Time=i, WBTemp=i) for i in range(100)])
+    arr, _ = ingest.parse_lines(lines, numpy.arange(100) * 10)
+    ddir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(ddir, 'log.bin')
+        binlog.write(fn, arr)
+        # a partial record at the tail is ignored
+        with open(fn, 'ab') as f:
+            f.write(b'\x00' * 10)
+        m = binlog.MappedLog(fn)
+        assert len(m) == 100
+        assert isinstance(m['WBTemp'], numpy.memmap)
+        assert numpy.all(m['WBTemp'] == arr['WBTemp'])
+        assert m.index(95, 205) == (10, 21)
+        assert m.index(2000) == (100, 100)
+        assert m.index(end=0) == (0, 0)
+        cols = m.columns(95, 205, ['Time', ])
+        assert list(cols['Time']) == list(range(10, 21))
+        assert numpy.shares_memory(m.slice(95, 205), m.data)
+
+        with open(fn, 'r+b') as f:
+            f.write(b'X')
+        try:
+            binlog.MappedLog(fn)
+            assert False
+        except binlog.BinaryLogError:
+            assert True
+
+        # bin archives are read through the mapped log
+        db_fn = os.path.join(ddir, '200101.sqlite')
+        db = sqlite3.connect(db_fn)
+        logger.create_table(db)
+        ingest.insert_array(db, arr)
+        db.close()
+        path = archive.compact(db_fn, 'bin', remove=True)
+        assert path.endswith('.bin')
+        assert numpy.all(query.load_range(ddir) == arr)
+        assert len(logger.load_file(db_fn, start=95, end=205)) == 11
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_storage():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'storage': 'binary',
+            'batch_size': 4,
+        })
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(2 * 24):
+            ts = t0 + datetime.timedelta(hours=i)
+            l.parse_line(build_line(Time=i), ts)
+        assert l.db is None
+        fn = l.db_fn
+        assert fn.endswith('.bin')
+        l.close()
+        assert sorted(os.listdir(ddir)) == ['200101.bin', '200102.bin']
+        arr = query.load_range(ddir)
+        assert list(arr['Time']) == list(range(48))
+
+        # a partially written record is dropped on open
+        with open(fn, 'ab') as f:
+            f.write(b'\x01' * 7)
+        s = storage.open_storage(
+            'binary', os.path.splitext(fn)[0], {'fsync_interval': 0})
+        assert binlog.count_records(fn) == 24
+        assert os.path.getsize(fn) == (
+            binlog.header_dtype.itemsize +
+            24 * binlog.get_record_dtype().itemsize)
+        r = logger.Reading()
+        r.from_line(build_line(Time=48), t0 + datetime.timedelta(days=2))
+        r.to_db(s)
+        s.close()
+        arr = query.load_range(ddir)
+        assert list(arr['Time']) == list(range(49))
+
+        # in memory sqlite storage
+        s = storage.open_storage('sqlite', ':memory:', {})
+        r.to_db(s)
+        assert len(get_all(s.db)) == 1
+        try:
+            storage.open_storage('foo', ':memory:', {})
+            assert False
+        except ValueError:
+            assert True
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_ui():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir})
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(100):
+            ts = t0 + datetime.timedelta(minutes=i)
+            l.parse_line(build_line(Time=i, WBTemp=i), ts)
+        l.flush()
+
+        app = ui.create_app({'data_dir': ddir})
+        client = app.test_client()
+        assert client.get('/').status_code == 200
+
+        d = client.get('/api/latest?n=2').get_json()
+        assert d['Time'] == [98, 99]
+        # new rows are appended to the ring buffer
+        l.parse_line(build_line(Time=100), t0 + datetime.timedelta(hours=2))
+        l.flush()
+        app.config['latest'].last_poll = None
+        d = client.get('/api/latest').get_json()
+        assert d['Time'] == list(range(101))
+
+        start = t0.timestamp()
+        url = '/api/history?start=%s&end=%s&points=10&columns=WBTemp' % (
+            start, start + 6000)
+        d = client.get(url).get_json()
+        assert list(d.keys()) == ['Timestamp', 'WBTemp']
+        assert len(d['Timestamp']) == 10
+        cache = app.config['cache']
+        assert cache.misses == 1
+        client.get(url)
+        assert cache.hits == 1
+        stats = client.get('/api/stats').get_json()
+        assert stats['results_misses'] == 1
+
+        r = client.get(url + '&format=npy')
+        arr = numpy.load(io.BytesIO(r.data))
+        assert arr.dtype.names == ('Timestamp', 'WBTemp')
+        assert client.get(url + 'Foo').status_code == 400
+        l.close()
+
+        # expired and evicted entries
+        c = ui.TTLCache(max_size=2, ttl=0.)
+        c.put(1, 1)
+        assert c.get(1) is None
+        c = ui.TTLCache(max_size=2)
+        for i in range(3):
+            c.put(i, i)
+        assert c.get(0) is None
+        assert c.get(2) == 2
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_ring():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(ddir, 'ring')
+        l = logger.Logger({
+            'data_dir': ':memory:',
+            'ring_size': 5,
+            'ring_file': fn,
+        })
+        assert len(l.latest()) == 0
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(7):
+            l.parse_line(build_line(Time=i), t0 + datetime.timedelta(i))
+        assert list(l.latest()['Time']) == [2, 3, 4, 5, 6]
+        assert list(l.latest(2)['Time']) == [5, 6]
+
+        # readers see the writer's readings through the file
+        r = ring.RingBuffer(fn=fn, writable=False)
+        assert r.capacity == 5
+        assert r.count == 7
+        assert r.latest()['Time'] == 6
+        l.parse_line(build_line(Time=7), t0)
+        assert r.latest()['Time'] == 7
+        assert len(r.get(0)) == 0
+
+        # a reader retries while a write is in progress
+        r.header = r.header.copy()
+        r.header['seq'] += 1
+        try:
+            r.get(retries=2)
+            assert False
+        except ring.RingBufferError:
+            assert True
+        l.close()
+
+        # reopening keeps the readings
+        b = ring.RingBuffer(5, fn)
+        assert list(b.get()['Time']) == [3, 4, 5, 6, 7]
+        # and resizing clears them
+        b = ring.RingBuffer(3, fn)
+        assert len(b) == 0
+
+        # ui uses the shared ring buffer
+        app = ui.create_app({'data_dir': ddir, 'ring_file': fn})
+        d = app.test_client().get('/api/latest').get_json()
+        assert d['Time'] == []
+
+        # the ring is only kept when shared
+        l = logger.Logger({'data_dir': ':memory:'})
+        assert l.ring is None and l.latest() is None
+        l.close()
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_stream():
+    p = stream.Publisher(queue_size=3)
+    all_fields = p.subscribe()
+    s = p.subscribe(fields=['Time', 'Rain'], decimate=2)
+    try:
+        p.subscribe(fields=['Foo', ])
+        assert False
+    except ValueError:
+        assert True
+    r = logger.Reading()
+    ts = datetime.datetime.fromtimestamp(5E8)
+    for i in range(8):
+        r.from_line(build_line(Time=i, Rain=0.5), ts)
+        p.publish(r.to_row())
+    # slow consumers lose the oldest readings
+    assert all_fields.n_dropped == 5
+    assert all_fields.get()['Time'] == 5
+    assert s.n_dropped == 1
+    assert s.get() == {'Time': 2, 'Rain': 0.5}
+    assert s.get()['Time'] == 4
+    p.unsubscribe(all_fields)
+    p.unsubscribe(s)
+
+    # server-sent events from the logger
+    serial.Serial = MockSerial
+    l = logger.Logger({
+        'data_dir': ':memory:',
+        'stream': True,
+        'stream_port': 0,
+    })
+    host, port = l.publisher.server.server_address
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    conn.request('GET', '/stream?fields=Time&decimate=1')
+    resp = conn.getresponse()
+    assert resp.status == 200
+    t0 = time.monotonic()
+    while not len(l.publisher.subscribers) and time.monotonic() - t0 < 5:
+        time.sleep(0.01)
+    l.parse_line(build_line(Time=3), ts)
+    assert resp.readline() == b'data: {"Time": 3}\n'
+    conn.close()
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    conn.request('GET', '/stream?fields=Foo')
+    assert conn.getresponse().status == 400
+    conn.close()
+    l.close()
+
+
+def test_derived():
+    # sliding window stats match a direct calculation
+    s = derived.SlidingStats(10)
+    vs = numpy.sin(numpy.arange(50.)) * 10
+    for (t, v) in enumerate(vs):
+        s.add(t, v)
+        w = vs[max(0, t - 9):t + 1]
+        assert s.n == len(w)
+        assert abs(s.mean - w.mean()) < 1e-9
+        assert abs(s.sum - w.sum()) < 1e-9
+        assert s.min == w.min() and s.max == w.max()
+        if len(w) > 1:
+            assert abs(s.std - w.std(ddof=1)) < 1e-9
+
+    assert abs(derived.dew_point(20., 50.) - 9.26) < 0.01
+    assert abs(derived.dew_point(15., 100.) - 15.) < 1e-9
+
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir,
+            'derived': True,
+            'derived_window': 60.,
+        })
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(20):
+            ts = t0 + datetime.timedelta(seconds=i * 10)
+            l.parse_line(build_line(
+                WindDir=350 if i % 2 else 10, WindSpd=i, Rain=0.5,
+                WBTemp=20, WBHum=50), ts)
+        l.close()
+        arr = derived.load_range(ddir)
+        assert len(arr) == 20
+        assert numpy.allclose(arr['DewPoint'], derived.dew_point(20, 50))
+        # 6 readings of 0.5 in the last 60 seconds
+        assert numpy.allclose(arr['RainRate'][-1], 3 * 60)
+        assert list(arr['WindGust'][-3:]) == [17, 18, 19]
+        # speed weighted vector average of alternating 350 and 10
+        wd = arr['WindAvgDir'][-6:]
+        assert numpy.all(numpy.minimum(wd, 360 - wd) < 1.)
+        assert numpy.all(arr['TempStd'] == 0)
+
+        try:
+            config.load_config({'derived': True, 'storage': 'binary'})
+            assert False
+        except config.ConfigError:
+            assert True
+        try:
+            config.load_config({'derived': True, 'archive_remove': True})
+            assert False
+        except config.ConfigError:
+            assert True
+
+        # files without a derived table and removed files are skipped
+        l = logger.Logger({'data_dir': ddir})
+        l.parse_line(build_line(), t0 + datetime.timedelta(days=1))
+        l.close()
+        assert len(query.find_files(ddir)) == 2
+        assert len(derived.load_range(ddir)) == 20
+        fn = query.find_files(ddir)[0]
+        archive.compact(fn, 'npz', remove=True)
+        assert not os.path.exists(fn)
+        assert len(derived.load_range(ddir)) == 0
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_backfill():
+    serial.Serial = MockSerial
+    # workers are forked, no (leaked) logger threads may be running
+    assert [t for t in threading.enumerate() if not t.daemon] == [
+        threading.main_thread()]
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir})
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(4 * 48):
+            ts = t0 + datetime.timedelta(minutes=i * 30)
+            l.parse_line(build_line(Time=i, WBTemp=i, Rain=0.5), ts)
+        l.close()
+        fns = query.find_files(ddir)
+
+        r = backfill.run(ddir, 'validate', 2, chunk_size=10, verbose=False)
+        assert sorted(r.keys()) == fns
+        assert all([v['rows'] == 48 for v in r.values()])
+        assert all([v['nan'] == 0 for v in r.values()])
+
+        backfill.run(ddir, 'rollup', 2, chunk_size=7, verbose=False)
+        parallel = rollup.load(ddir, t0, t0 + datetime.timedelta(days=4))
+        # resuming redoes unfinished and modified files without counting
+        # them twice
+        c = backfill.Checkpoint(ddir, 'rollup')
+        for fn in fns[1:]:
+            c.mark(fn)
+        os.utime(fns[1], (time.time() + 10, time.time() + 10))
+        r = backfill.run(ddir, 'rollup', 2, chunk_size=7, verbose=False)
+        assert sorted(r.keys()) == fns[:2]
+        resumed = rollup.load(ddir, t0, t0 + datetime.timedelta(days=4))
+        assert numpy.all(resumed == parallel)
+        rollup.backfill(ddir)
+        serial_ = rollup.load(ddir, t0, t0 + datetime.timedelta(days=4))
+        assert numpy.all(parallel == serial_)
+
+        # resume from a checkpoint, only unfinished files are processed
+        c = backfill.Checkpoint(ddir, 'index')
+        c.mark(fns[0])
+        r = backfill.run(ddir, 'index', 2, verbose=False)
+        assert sorted(r.keys()) == fns[1:]
+        assert not os.path.exists(c.fn)
+
+        r = backfill.run(ddir, 'archive', 2, verbose=False, fmt='cols')
+        assert sorted(r.keys()) == fns[:-1]
+        assert archive.find(fns[0]) == archive.get_path(fns[0], 'cols')
+        assert archive.find(fns[-1]) is None
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_bench():
+    r = bench.run(n=200, splits=2, load_days=(2, ), rows_per_day=48)
+    json.dumps(r)
+    assert r['from_line']['lines'] == 200
+    assert len(r['log_line']) == 4
+    assert r['load'][0]['rows'] == 96
+
+
+def test_metrics():
+    serial.Serial = MockSerial
+    l = logger.Logger({'data_dir': ':memory:'})
+    assert not l.metrics.enabled
+    l.parse_line(build_line())
+    assert l.metrics.lines_parsed.value == 0
+    assert l.metrics.render() == '\n'
+    l.close()
+
+    l = logger.Logger({'data_dir': ':memory:', 'metrics': True})
+    m = l.metrics
+    l.conn.lines = [
+        build_line(Time=1).encode('ascii') + b'\n', b'#comment\n',
+        b'1,2\n', build_line(Time=2).encode('ascii') + b'\n']
+    for _ in range(4):
+        l.read_serial_line()
+    assert m.lines_read.value == 4
+    assert m.lines_parsed.value == 2
+    assert m.lines_rejected.value == 1
+    assert m.lines_commented.value == 1
+    assert m.bytes_read.value == sum([
+        len(build_line(Time=i)) + 1 for i in (1, 2)]) + 13
+    assert m.parse_time.count == 2
+    assert m.write_time.count == 2
+    assert m.split_time.count == 1
+    assert 'parsed 2 rejected 1' in m.report()
+
+    host, port = m.serve('127.0.0.1', 0)
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    conn.request('GET', '/metrics')
+    resp = conn.getresponse()
+    assert resp.status == 200
+    text = resp.read().decode('ascii')
+    assert 'pymicroclimate_lines_parsed_total 2\n' in text
+    assert 'pymicroclimate_parse_seconds_count 2\n' in text
+    assert 'pymicroclimate_split_seconds_bucket{le="+Inf"} 1\n' in text
+    conn.close()
+    l.close()
+    assert m.server is None
+
+    h = metrics.Histogram('h', '', [1, 2, 3])
+    for v in (0.5, 1.5, 1.5, 2.5, 10):
+        h.observe(v)
+    assert h.counts == [1, 2, 1, 1]
+    assert h.quantile(0.5) == 2
+    assert h.quantile(1.) == float('inf')
+
+
+def test_protocol():
+    values = [(i, 1.5, 90., 2.5, 0.25, 20.5, 101325., 50., 18.5, i)
+              for i in range(3)]
+    frames = b''.join([protocol.encode(v) for v in values])
+    assert len(frames) == 3 * protocol.frame_size
+    d = protocol.FrameDecoder()
+    # frames split across reads and mixed with text lines
+    records, lines = d.feed(b'#header\n' + frames[:10])
+    assert len(records) == 0
+    assert lines == [b'#header', ]
+    records, lines = d.feed(frames[10:] + b'1,2\n')
+    assert records.tolist() == [tuple(v) for v in values]
+    assert lines == [b'1,2', ]
+    assert len(d.buffer) == 0
+
+    # corrupt frames are skipped
+    bad = bytearray(frames)
+    bad[10] ^= 0xFF
+    records, lines = d.feed(bytes(bad))
+    assert records['Time'].tolist() == [1, 2]
+    assert lines == []
+    assert d.n_bad > 0
+
+    # binary only keeps comments
+    d = protocol.FrameDecoder(text=False)
+    records, lines = d.feed(b'#c\n1,2\n' + frames)
+    assert len(records) == 3
+    assert lines == [b'#c', ]
+
+    serial.Serial = MockSerial
+    try:
+        config.load_config({'protocol': 'binary', 'pipeline': True})
+        assert False
+    except config.ConfigError:
+        assert True
+    l = logger.Logger({'data_dir': ':memory:', 'protocol': 'auto'})
+    l.conn.lines = [
+        b'#comment\n' + frames + build_line(Time=3).encode('ascii') + b'\n']
+    r = l.port_reader(l.conn, 0)
+    while l.conn.in_waiting:
+        l.read_port(r)
+    # lines and frames from one read share a timestamp
+    rows = sorted(get_all(l.db), key=lambda row: row[1])
+    assert [row[1] for row in rows] == [0, 1, 2, 3]
+    assert rows[0][6] == 20.5
+    l.close()
+
+
+def test_wal():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir, 'checkpoint_interval': 0.01})
+        ts = datetime.datetime(2020, 1, 1)
+        l.parse_line(build_line(Time=1), ts)
+        fn = l.db_fn
+        assert l.db.execute('pragma journal_mode').fetchone()[0] == 'wal'
+
+        # an open read transaction does not block the writer
+        reader = query.connect(fn)
+        reader.execute('begin')
+        assert reader.execute(
+            'select count(*) from weather').fetchone()[0] == 1
+        l.parse_line(build_line(Time=2), ts)
+        assert reader.execute(
+            'select count(*) from weather').fetchone()[0] == 1
+        reader.commit()
+        assert len(logger.load_file(fn)) == 2
+        try:
+            reader.execute('delete from weather')
+            assert False
+        except sqlite3.OperationalError:
+            assert True
+        reader.close()
+
+        t0 = time.monotonic()
+        c = l.storage.checkpointer
+        while c.n_checkpoints < 1 and time.monotonic() - t0 < 5:
+            time.sleep(0.01)
+        assert c.n_checkpoints > 0
+        l.close()
+        assert not c.thread.is_alive()
+        assert not os.path.exists(fn + '-wal')
+    finally:
+        shutil.rmtree(ddir)
+
+    # files finalized by a split (and archived) are self contained, as
+    # are prepared files that are discarded
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({
+            'data_dir': ddir, 'archive': 'npz', 'archive_remove': True})
+        ts = datetime.datetime(2020, 1, 1, 23, 59, 59)
+        l.parse_line(build_line(Time=1), ts)
+        l.parse_line(build_line(Time=2), ts + datetime.timedelta(seconds=2))
+        l.wait()
+        assert sorted(os.listdir(ddir)) == [
+            '200101.npz', '200102.sqlite', '200102.sqlite-shm',
+            '200102.sqlite-wal']
+        l.parse_line(
+            build_line(Time=3), datetime.datetime(2020, 1, 2, 23, 59, 59))
+        assert l.next is not None
+        l.close()
+        assert sorted(os.listdir(ddir)) == ['200101.npz', '200102.sqlite']
+        assert len(logger.load_file(os.path.join(ddir, '200102.sqlite'))) == 2
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_capture():
+    ddir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(ddir, 'capture.bin')
+        t0 = datetime.datetime(2020, 1, 1).timestamp()
+        c = capture.Capture(fn)
+        for (t, station, data) in capture.synthetic(10, 2., t0, 2):
+            c.write(data, t, station)
+        c.close()
+        # a partial record is dropped when appending
+        with open(fn, 'ab') as f:
+            f.write(b'\x00' * 5)
+        c = capture.Capture(fn)
+        assert c.n_records == 20
+        c.close()
+        records = list(capture.read_capture(fn))
+        assert len(records) == 20
+        assert records[1][:2] == (t0, 1)
+
+        # replay both stations as fast as possible with capture times
+        conns = [capture.ReplaySerial(fn, station) for station in (0, 1)]
+        l = logger.Logger({
+            'data_dir': os.path.join(ddir, 'data'),
+            'ports': ['a', 'b'],
+        }, conns)
+        capture.replay(l)
+        arr = query.load_range(os.path.join(ddir, 'data'))
+        l.close()
+        assert len(arr) == 20
+        assert arr['Timestamp'][0] == t0
+        assert sorted(set(arr['Station'].tolist())) == [0, 1]
+
+        # replay at 100x real time
+        conn = capture.ReplaySerial(
+            capture.synthetic(4, 1., t0), None, speed=100.)
+        t = time.monotonic()
+        lines = [conn.readline() for _ in range(5)]
+        assert time.monotonic() - t >= 0.03
+        assert conn.eof and lines[-1] == b''
+        assert conn.last_timestamp == datetime.datetime.fromtimestamp(t0 + 3)
+
+        # capture while logging
+        serial.Serial = MockSerial
+        fn = os.path.join(ddir, 'log.bin')
+        l = logger.Logger({'data_dir': ':memory:', 'capture_file': fn})
+        line = build_line(Time=5).encode('ascii') + b'\n'
+        l.conn.lines = [line, ]
+        l.read_serial_line()
+        l.close()
+        records = list(capture.read_capture(fn))
+        assert [r[2] for r in records] == [line, ]
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_pool():
+    serial.Serial = MockSerial
+    ddir = tempfile.mkdtemp()
+    try:
+        l = logger.Logger({'data_dir': ddir})
+        t0 = datetime.datetime(2020, 1, 1)
+        for i in range(3 * 24):
+            l.parse_line(
+                build_line(Time=i), t0 + datetime.timedelta(hours=i))
+        l.close()
+        fns = query.find_files(ddir)
+        pool = query.ConnectionPool(2)
+        for fn in fns:
+            arr = logger.load_file(fn, pool=pool)
+            assert numpy.all(arr == logger.load_file(fn))
+        assert (pool.hits, pool.misses, pool.evictions) == (0, 3, 1)
+        logger.load_file(fns[-1], columns=['Time', ], pool=pool)
+        assert pool.hits == 1
+        arr = query.load_range(ddir, t0, t0 + datetime.timedelta(days=2),
+                               pool=pool)
+        assert len(arr) == 48
+        assert pool.n_idle == 2
+
+        # threads share the pool, a connection is used by one at a time
+        errors = []
+
+        def read():
+            try:
+                for i in range(20):
+                    fn = fns[i % len(fns)]
+                    assert len(logger.load_file(fn, pool=pool)) == 24
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert pool.n_idle <= 2
+
+        # a replaced file is not read through an old connection
+        os.remove(fns[0])
+        l = logger.Logger({'data_dir': ddir})
+        l.parse_line(build_line(Time=1), t0)
+        l.close()
+        assert len(logger.load_file(fns[0], pool=pool)) == 1
+        pool.close()
+        assert pool.n_idle == 0
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_analysis():
+    # sketches and histograms agree with exact quantiles
+    rng = numpy.random.default_rng(0)
+    values = rng.normal(20, 5, 100000)
+    s = analysis.Sketch()
+    h = analysis.Histogram(analysis.bin_edges['WBTemp'])
+    for chunk in numpy.array_split(values, 10):
+        s.add(chunk)
+        h.add(chunk)
+    assert s.n == h.n == len(values)
+    assert len(s.means) < 1000
+    for q in (0.001, 0.01, 0.5, 0.99, 0.999):
+        v = numpy.quantile(values, q)
+        assert abs(s.quantile(q) - v) < 0.1
+        assert abs(h.quantile(q) - v) < 0.25
+    assert s.quantile(0) == values.min()
+    assert s.quantile(1) == values.max()
+    # merged sketches are as good as one sketch of all values
+    a, b = analysis.Sketch(), analysis.Sketch()
+    a.add(values[:50000])
+    b.add(values[50000:] + 10)
+    a.merge(b)
+    both = numpy.concatenate([values[:50000], values[50000:] + 10])
+    assert abs(a.quantile(0.5) - numpy.quantile(both, 0.5)) < 0.1
+
+    r = analysis.WindRose()
+    r.add(numpy.array([0, 359, 11, 12, 180, numpy.nan]),
+          numpy.array([1, 1, 3, 3, 20, 1]))
+    assert r.n == 5
+    assert r.counts[0].tolist() == [0, 2, 1, 0, 0, 0, 0, 0]
+    assert r.counts[1, 2] == 1
+    assert r.counts[8, 7] == 1
+
+    ddir = tempfile.mkdtemp()
+    try:
+        bench.make_days(ddir, 3, 1440)
+        arr = query.load_range(ddir)
+        cache = analysis.Cache(ddir)
+        s = analysis.summarize(ddir, cache=cache)
+        assert (cache.hits, cache.misses) == (0, 3)
+        assert s.n == len(arr)
+        assert (s.start, s.end) == (arr['Timestamp'][0], arr['Timestamp'][-1])
+        assert s.wind_rose.n == len(arr)
+        assert s.histograms['WBTemp'].n == len(arr)
+        for q in (0.1, 0.5, 0.9):
+            v = numpy.quantile(arr['WBTemp'], q)
+            assert abs(s.quantiles('WBTemp', [q])[0] - v) < 0.02
+        # cached summaries are reused, partial files are filtered
+        t0 = datetime.datetime(2020, 1, 1, 12)
+        t1 = datetime.datetime(2020, 1, 3)
+        s = analysis.summarize(ddir, t0, t1, cache=cache)
+        assert (cache.hits, cache.misses) == (2, 3)
+        ts = arr['Timestamp']
+        assert s.n == numpy.sum(
+            (ts >= t0.timestamp()) & (ts < t1.timestamp()))
+        # summaries survive a round trip through the cache
+        s2 = analysis.Summary.from_bytes(s.to_bytes())
+        assert s2.n == s.n and (s2.start, s2.end) == (s.start, s.end)
+        assert s2.quantiles('Light', [0.5]) == s.quantiles('Light', [0.5])
+        cache.close()
+        # a changed file is summarized again
+        fn = query.find_files(ddir)[-1]
+        db = sqlite3.connect(fn)
+        ingest.insert_array(db, arr[-10:])
+        db.close()
+        cache = analysis.Cache(ddir)
+        s = analysis.summarize(ddir, cache=cache)
+        assert (cache.hits, cache.misses) == (2, 1)
+        assert s.n == len(arr) + 10
+        cache.close()
+        ms = analysis.summarize_months(
+            ddir, datetime.datetime(2019, 12, 15), datetime.datetime(2020, 2, 1))
+        assert [t.month for (t, _) in ms] == [12, 1]
+        assert [m.n for (_, m) in ms] == [0, len(arr) + 10]
+    finally:
+        shutil.rmtree(ddir)
+
+
+def test_cache():
+    ddir = tempfile.mkdtemp()
+    try:
+        bench.make_days(ddir, 3, 1440)
+        fns = query.find_files(ddir)
+        cdir = os.path.join(ddir, 'cache')
+        c = cache.ResultCache(cache_dir=cdir)
+        assert all([c.is_closed(fn) for fn in fns[:-1]])
+        assert not c.is_closed(fns[-1])
+        t0 = datetime.datetime(2020, 1, 1, 12)
+        t1 = datetime.datetime(2020, 1, 3, 12)
+        expected = query.load_range(ddir, t0, t1, ['Timestamp', 'WBTemp'])
+        arr = query.load_range(ddir, t0, t1, ['Timestamp', 'WBTemp'], cache=c)
+        assert numpy.all(arr == expected)
+        assert (c.hits, c.misses) == (0, 3)
+        # whole (middle) files are shared by other ranges
+        columns = ['Timestamp', 'WBTemp']
+        query.load_range(ddir, t0, t1, columns, cache=c)
+        query.load_range(
+            ddir, t0 + datetime.timedelta(hours=1), t1, columns, cache=c)
+        assert (c.hits, c.misses) == (5, 4)
+        assert not c.load(fns[0]).flags.writeable
+        # rows are in Timestamp order, even without Timestamp
+        arr = c.load(fns[1], columns=['Light'])
+        assert arr.dtype.names == ('Light', )
+        assert numpy.all(arr == logger.load_file(fns[1], columns=['Light']))
+        # closed files are kept on disk, the open file only in memory
+        assert c.stats()['disk_entries'] == 5
+        c2 = cache.ResultCache(cache_dir=cdir)
+        c2.load(fns[0])
+        c2.load(fns[2])
+        assert (c2.disk_hits, c2.misses) == (1, 1)
+        # the open file is read again when written to
+        db = sqlite3.connect(fns[2])
+        ingest.insert_array(db, logger.load_file(fns[2])[:10])
+        db.close()
+        # mtime may not change within the filesystem resolution
+        os.utime(fns[2], ns=(0, 0))
+        assert len(c2.load(fns[2])) == 1450
+        assert (c2.hits, c2.misses) == (0, 2)
+        assert len(c2.load(fns[2])) == 1450
+        assert c2.hits == 1
+
+        # memory and disk are bounded
+        n = c.load(fns[0]).nbytes
+        c = cache.ResultCache(int(n * 1.5), cdir, 1)
+        c.load(fns[0])
+        c.load(fns[1])
+        assert c.nbytes == n and c.evictions == 1
+        assert c.stats()['disk_entries'] == 0
+        assert os.listdir(cdir) == []
+    finally:
+        shutil.rmtree(ddir)
 
-    # TODO save to temp files to test split by hour
 
 def run():
     test_config()
     test_reading()
     test_logger()
+    test_batch_writer()
+    test_pipeline()
+    test_multi_station()
+    test_ingest()
+    test_load_range()
+    test_schema()
+    test_rollup()
+    test_archive()
+    test_binlog()
+    test_storage()
+    test_ui()
+    test_ring()
+    test_stream()
+    test_derived()
+    test_backfill()
+    test_bench()
+    test_metrics()
+    test_protocol()
+    test_wal()
+    test_capture()
+    test_pool()
+    test_analysis()
+    test_cache()
@@ -0,0 +1,306 @@
+import argparse
+import collections
+import io
+import os
+import threading
+import time
+
+import flask
+import numpy
+
+from . import cache as result_cache
+from . import config
+from . import logger
+from . import query
+from . import ring
+from . import rollup
+
+
+page = """<!doctype html>
+<html>
+<head>
+<title>pymicroclimate</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+td { padding: 0 1em 0 0; }
+svg { border: 1px solid #ccc; }
+</style>
+</head>
+<body>
+<h2>Current conditions</h2>
+<table id="current"></table>
+<h2>History</h2>
+<select id="field"></select>
+<select id="span">
+<option value="3600">1 hour</option>
+<option value="86400" selected>1 day</option>
+<option value="604800">1 week</option>
+<option value="2592000">30 days</option>
+<option value="31536000">1 year</option>
+</select>
+<div><svg id="chart" width="800" height="300"></svg></div>
+<script>
+var fields = %(fields)s;
+var field = document.getElementById('field');
+fields.forEach(function (f) {
+  var o = document.createElement('option');
+  o.value = o.text = f;
+  field.appendChild(o);
+});
+field.value = 'WBTemp';
+
+function current() {
+  fetch('api/latest?n=1').then(r => r.json()).then(function (d) {
+    var rows = '';
+    Object.keys(d).forEach(function (k) {
+      rows += '<tr><td>' + k + '</td><td>' + d[k][0] + '</td></tr>';
+    });
+    document.getElementById('current').innerHTML = rows;
+  });
+}
+
+function history() {
+  var end = Date.now() / 1000;
+  var start = end - Number(document.getElementById('span').value);
+  var f = field.value;
+  fetch('api/history?start=' + start + '&end=' + end + '&points=800' +
+        '&columns=' + f).then(r => r.json()).then(function (d) {
+    var t = d.Timestamp;
+    var v = d[f + '_mean'] || d[f];
+    var ok = v.filter(x => x !== null);
+    var lo = Math.min.apply(null, ok), hi = Math.max.apply(null, ok);
+    var pts = [];
+    for (var i = 0; i < t.length; i++) {
+      if (v[i] === null) continue;
+      pts.push(((t[i] - start) / (end - start) * 800).toFixed(1) + ',' +
+               (290 - (v[i] - lo) / ((hi - lo) || 1) * 280).toFixed(1));
+    }
+    document.getElementById('chart').innerHTML =
+      '<polyline fill="none" stroke="steelblue" points="' +
+      pts.join(' ') + '"/>' +
+      '<text x="5" y="15">' + hi + '</text>' +
+      '<text x="5" y="295">' + lo + '</text>';
+  });
+}
+
+field.onchange = history;
+document.getElementById('span').onchange = history;
+current();
+history();
+setInterval(current, 5000);
+setInterval(history, 60000);
+</script>
+</body>
+</html>
+"""
+
+
+class TTLCache:
+    # least recently used cache with entries that expire after ttl seconds
+    def __init__(self, max_size=64, ttl=60.):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class Latest:
+    # ring buffer of the most recent readings, filled by reading only
+    # new rows from the newest database files
+    def __init__(self, data_dir, size=720, poll_interval=2., pool=None):
+        self.data_dir = data_dir
+        self.pool = pool
+        self.rows = collections.deque(maxlen=size)
+        self.poll_interval = poll_interval
+        self.last_poll = None
+        self.last_timestamp = None
+        self.lock = threading.Lock()
+
+    def update(self):
+        with self.lock:
+            now = time.monotonic()
+            if (
+                    self.last_poll is not None and
+                    now - self.last_poll < self.poll_interval):
+                return
+            self.last_poll = now
+            fns = query.find_files(self.data_dir)
+            if not len(fns):
+                return
+            start = None
+            if self.last_timestamp is not None:
+                start = self.last_timestamp + 1
+            # the next file can be opened before the current one is done
+            for fn in fns[-2:]:
+                arr = logger.load_file(fn, start=start, pool=self.pool)
+                if len(arr):
+                    self.rows.extend(arr)
+                    self.last_timestamp = int(arr['Timestamp'][-1])
+                    start = self.last_timestamp + 1
+
+    def get(self, n=None):
+        self.update()
+        with self.lock:
+            rows = list(self.rows)
+        if n is not None:
+            rows = rows[-n:] if n > 0 else []
+        return numpy.array(rows, dtype=logger.row_dtype)
+
+
+def to_columns(arr):
+    # columnar dict of lists, nan is replaced by None for json
+    d = {}
+    for n in arr.dtype.names:
+        vs = arr[n].tolist()
+        if arr.dtype[n].kind == 'f':
+            vs = [None if v != v else v for v in vs]
+        d[n] = vs
+    return d
+
+
+def encode(arr, fmt='json'):
+    # response body and mimetype, npy is the binary numpy format
+    if fmt == 'npy':
+        bs = io.BytesIO()
+        numpy.save(bs, arr)
+        return bs.getvalue(), 'application/octet-stream'
+    return flask.json.dumps(to_columns(arr)), 'application/json'
+
+
+def respond(arr, fmt='json'):
+    body, mimetype = encode(arr, fmt)
+    return flask.Response(body, mimetype=mimetype)
+
+
+def load_history(
+        data_dir, start, end, points, columns=None, pool=None, results=None):
+    # rollups if available, otherwise decimated raw data
+    if os.path.exists(rollup.get_path(data_dir)):
+        return rollup.load(data_dir, start, end, points, columns)
+    if columns is not None:
+        columns = ['Timestamp', ] + [c for c in columns if c != 'Timestamp']
+    arr = query.load_range(
+        data_dir, start, end, columns, pool=pool, cache=results)
+    if len(arr) > points:
+        arr = arr[::int(numpy.ceil(len(arr) / points))]
+    return arr
+
+
+def create_app(cfg=None):
+    cfg = config.load_config(cfg)
+    app = flask.Flask(__name__)
+    data_dir = cfg['data_dir']
+    cache = TTLCache(cfg['cache_size'], cfg['cache_ttl'])
+    # request threads share read only database connections
+    pool = query.ConnectionPool(cfg['pool_size'])
+    # decoded rows of closed files are reused between history ranges
+    results = result_cache.create(cfg)
+    # prefer the ring buffer shared by a running logger
+    ring_fn = os.path.expanduser(cfg['ring_file'])
+    if cfg['ring_file'] and os.path.exists(ring_fn):
+        latest = ring.RingBuffer(fn=ring_fn, writable=False)
+    else:
+        latest = Latest(data_dir, pool=pool)
+    app.config['cache'] = cache
+    app.config['pool'] = pool
+    app.config['results'] = results
+    app.config['latest'] = latest
+
+    @app.route('/')
+    def index():
+        return page % {'fields': flask.json.dumps(rollup.fields)}
+
+    @app.route('/api/latest')
+    def api_latest():
+        n = flask.request.args.get('n', None, type=int)
+        return respond(
+            latest.get(n), flask.request.args.get('format', 'json'))
+
+    @app.route('/api/history')
+    def api_history():
+        args = flask.request.args
+        now = time.time()
+        end = args.get('end', now, type=float)
+        start = args.get('start', end - 86400, type=float)
+        points = args.get('points', 1000, type=int)
+        columns = args.get('columns', None)
+        fmt = args.get('format', 'json')
+        if columns is not None:
+            columns = tuple(columns.split(','))
+        # align the range to the resolution so clients share entries
+        res = rollup.choose_resolution(start, end, points)
+        start = int(start - start % res)
+        end = int(end - end % res + res)
+        key = (start, end, res, columns, fmt)
+        r = cache.get(key)
+        if r is None:
+            try:
+                arr = load_history(
+                    data_dir, start, end, points, columns, pool, results)
+            except ValueError as e:
+                flask.abort(400, str(e))
+            r = encode(arr, fmt)
+            cache.put(key, r)
+        return flask.Response(r[0], mimetype=r[1])
+
+    @app.route('/api/stats')
+    def api_stats():
+        stats = {
+            'cache_hits': cache.hits,
+            'cache_misses': cache.misses,
+            'cache_size': len(cache.entries),
+            'pool_hits': pool.hits,
+            'pool_misses': pool.misses,
+            'pool_evictions': pool.evictions,
+        }
+        if results is not None:
+            for (k, v) in results.stats().items():
+                stats['results_' + k] = v
+        return flask.jsonify(stats)
+
+    return app
+
+
+def run_cmdline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', default=None, type=str,
+        help="Read config from file")
+    parser.add_argument(
+        '-d', '--data_dir', default=None, type=str,
+        help="Data directory to serve")
+    parser.add_argument(
+        '-H', '--host', default=None, type=str,
+        help="Address to serve on")
+    parser.add_argument(
+        '-p', '--port', default=None, type=int,
+        help="Port to serve on")
+    args = parser.parse_args()
+    cfg = config.load_config(fn=args.config)
+    if args.data_dir is not None:
+        cfg['data_dir'] = args.data_dir
+    if args.host is not None:
+        cfg['ui_host'] = args.host
+    if args.port is not None:
+        cfg['ui_port'] = args.port
+    app = create_app(cfg)
+    app.run(host=cfg['ui_host'], port=cfg['ui_port'], threaded=True)